@@ -1,7 +1,8 @@
 #!/usr/bin/env python
+import csv
+import os
 import numpy as np
 from scipy.io import savemat
-import random
 
 """ ~~~~~~~~~~~~~     TUNABLE PARAMETERS     ~~~~~~~~~~~~~ """
 # Colors dictionary that identifies the RGB values of the used colors
@@ -10,37 +11,152 @@ LETTERS = ["A", "B", "C", "D", "E", "H", "I", "K", "L", "M", "O", "P", "R", "S",
 NUM_TESTS = 75
 # Value for N
 N = 1
-# Frequency (1/Frequency = roughly proportion of yesses that warrant a "Yes" response
+# Frequency (1/Frequency = proportion of letters that warrant a "Yes" response)
 FREQUENCY = 3
+# Exact number of letters in each sequence that warrant a "Yes" response
+NUM_TARGETS = (NUM_TESTS - N) // FREQUENCY
+# Number of lures (a letter repeated N-1 or N+1 letters back, which warrants a "No") in each sequence, or None
+# to leave lures to chance. Exact for N = 1; for larger N a sequence occasionally ends up a lure short (the
+# manifest lists how many each one has)
+NUM_LURES = None
+# Pick the letters that aren't forced by a target or lure so that every letter is used about equally often
+BALANCE_LETTERS = False
+# Number of sequences to generate, and the seed that makes them reproducible (None for a random seed, which is
+# recorded in the manifest)
+NUM_SEQUENCES = 1
+SEED = None
+# Directory the NBACK_<N>_Version<label>.mat files (and a manifest of them) are written to
+OUTPUT_DIR = "."
 """~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~"""
 
+
+# Pick, for each row, one allowed value uniformly at random (or, with counts, the least used allowed value
+# with ties broken at random). allowed is a (rows, values) boolean array with at least one True per row.
+def _pick(rng, allowed, counts=None):
+    keys = rng.random(allowed.shape)
+    if counts is not None:
+        keys = keys + counts
+    keys[~allowed] = np.inf
+    return np.argmin(keys, axis=1)
+
+
+# Choose exactly k of the positions where mask is True in each row (every row needs at least k of them)
+def _choose_positions(rng, mask, k):
+    keys = rng.random(mask.shape)
+    keys[~mask] = np.inf
+    chosen = np.zeros(mask.shape, dtype=bool)
+    if k > 0:
+        np.put_along_axis(chosen, np.argsort(keys, axis=1)[:, :k], True, axis=1)
+    return chosen
+
+
+# Generate many N-back sequences at once. Every sequence has exactly num_targets letters matching the one n
+# back, and (if num_lures is given) num_lures non-matching letters that repeat the letter n-1 or n+1 back.
+# Lures are never placed right after a target when n = 1, since neither repeat is possible there; with larger
+# n, a lure that turns out to be impossible is moved to the next position that can take one, so a sequence only
+# falls short of num_lures when that happens too close to its end.
+# Work is vectorized across sequences, so generating thousands costs about as much as generating one.
+# Returns (letter indices, answers, lure mask), each of shape (num_sequences, num_tests).
+def generate_sequences(num_sequences, num_tests, n, num_targets, num_lures=None, balance_letters=False, seed=None,
+                       num_letters=len(LETTERS)):
+    if num_targets > num_tests - n:
+        raise ValueError(f"Can't fit {num_targets} targets into {num_tests} letters with N = {n}")
+    rng = np.random.default_rng(seed)
+    rows = np.arange(num_sequences)
+    positions = np.arange(num_tests)
+
+    # Decide up front exactly where the targets (and lures) go
+    is_target = _choose_positions(rng, np.broadcast_to(positions >= n, (num_sequences, num_tests)), num_targets)
+    is_lure = np.zeros((num_sequences, num_tests), dtype=bool)
+    if num_lures is not None:
+        lure_offsets = [n + 1] if n < 2 else [n - 1, n + 1]
+        can_lure = (positions >= n + 1) & ~is_target
+        if n == 1:
+            # A 1-back lure repeats the letter 2 back without matching the one in between, which is impossible
+            # right after a target (the letter 1 back then equals the letter 2 back)
+            can_lure[:, 1:] &= ~is_target[:, :-1]
+        if num_lures > np.count_nonzero(can_lure, axis=1).min():
+            raise ValueError(f"Can't fit {num_lures} lures alongside {num_targets} targets")
+        is_lure = _choose_positions(rng, can_lure, num_lures)
+
+    sequences = np.zeros((num_sequences, num_tests), dtype=int)
+    counts = np.zeros((num_sequences, num_letters)) if balance_letters else None
+    moved_lures = np.zeros(num_sequences, dtype=int)
+    for i in range(num_tests):
+        allowed = np.ones((num_sequences, num_letters), dtype=bool)
+        if i >= n:
+            # A non-target must differ from the letter n back
+            allowed[rows, sequences[:, i - n]] = False
+            if num_lures is not None:
+                # ...and from the letters n-1/n+1 back too, unless it is meant to be a lure
+                lure_allowed = np.zeros_like(allowed)
+                for offset in lure_offsets:
+                    if i >= offset:
+                        lure_allowed[rows, sequences[:, i - offset]] = True
+                lure_allowed &= allowed
+                # A lure that turns out to be impossible here is moved to the next position that can take one
+                wanted_lure = is_lure[:, i] | (can_lure[:, i] & (moved_lures > 0))
+                usable_lure = wanted_lure & lure_allowed.any(axis=1)
+                moved_lures += is_lure[:, i] & ~usable_lure
+                moved_lures -= usable_lure & ~is_lure[:, i]
+                is_lure[:, i] = usable_lure
+                allowed = np.where(usable_lure[:, np.newaxis], lure_allowed, allowed & ~lure_allowed)
+        sequences[:, i] = _pick(rng, allowed, counts)
+        if i >= n:
+            sequences[:, i] = np.where(is_target[:, i], sequences[:, i - n], sequences[:, i])
+        if counts is not None:
+            counts[rows, sequences[:, i]] += 1
+
+    answers = np.where(is_target, "Y", "N")
+    return sequences, answers, is_lure
+
+
+# Version labels in the style of the existing files: A, B, ..., Z, AA, AB, ...
+def version_label(index):
+    label = ""
+    index += 1
+    while index > 0:
+        index, remainder = divmod(index - 1, 26)
+        label = chr(ord("A") + remainder) + label
+    return label
+
+
+# Write each sequence to its own NBACK_<n>_Version<label>.mat in one pass, continuing after any versions that
+# already exist in output_dir, and list them (with the seed that produced them) in a manifest csv.
+# Returns the filenames written.
+def save_sequences(sequences, answers, is_lure, n, seed, output_dir=".", letters=LETTERS):
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    letters = np.array(letters, dtype=str)
+    filenames = []
+    version = 0
+    for i in range(len(sequences)):
+        while os.path.exists(os.path.join(output_dir, f"NBACK_{n}_Version{version_label(version)}.mat")):
+            version += 1
+        filename = os.path.join(output_dir, f"NBACK_{n}_Version{version_label(version)}.mat")
+        # Create dictionary containing the generated data, and save it as a mat file to be used
+        savemat(filename, {"Sequence": letters[sequences[i]], "Answers": answers[i]})
+        filenames.append(filename)
+
+    manifest_filename = os.path.join(output_dir, f"NBACK_{n}_manifest.csv")
+    write_header = not os.path.isfile(manifest_filename)
+    with open(manifest_filename, 'a') as manifest_file:
+        writer = csv.writer(manifest_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        if write_header:
+            writer.writerow(['File', 'N', 'Letters', 'Targets', 'Lures', 'Seed', 'Index in batch'])
+        for i, filename in enumerate(filenames):
+            writer.writerow([os.path.basename(filename), n, sequences.shape[1], np.count_nonzero(answers[i] == "Y"),
+                             np.count_nonzero(is_lure[i]), seed, i])
+    return filenames
+
+
 if __name__ == "__main__":
-    # Create test sequence and corresponding array containing correct answers (Y/N)
-    random.seed()
-    letter_index_sequence = np.empty(NUM_TESTS, dtype=int)
-    correct_answers = np.empty(NUM_TESTS, dtype=str)
-    for i in range(0, N):
-        correct_answers[i] = "N"
-    for i in range(NUM_TESTS):
-        # Generate a yes case
-        if (i > N) and (random.randint(0, FREQUENCY - 1) == 0):
-            letter_index_sequence[i] = letter_index_sequence[i-N]
-            correct_answers[i] = "Y"
-        # Generate a no case
-        else:
-            random_index = random.randint(0, len(LETTERS)-1)
-            if i >= N:
-                while random_index == letter_index_sequence[i-N]:
-                    random_index = random.randint(0, len(LETTERS) - 1)
-            letter_index_sequence[i] = random_index
-            correct_answers[i] = "N"
-    # Generate the sequence of letters from randomly generated indices
-    letter_sequence = np.empty(len(letter_index_sequence), dtype=str)
-    for i in range(len(letter_index_sequence)):
-        letter_sequence[i] = LETTERS[letter_index_sequence[i]]
-    print(letter_sequence)
-    print(correct_answers)
-    # Create dictionary containing the generated data
-    mdic = {"Sequence": letter_sequence, "Answers": correct_answers}
-    # Save dictionary as a mat file to be used
-    savemat("NBACK_1_VersionC.mat", mdic)
+    # Record the seed actually used so any batch can be regenerated exactly
+    seed = SEED if SEED is not None else int(np.random.SeedSequence().entropy)
+    sequences, answers, is_lure = generate_sequences(NUM_SEQUENCES, NUM_TESTS, N, NUM_TARGETS, NUM_LURES,
+                                                     BALANCE_LETTERS, seed)
+    filenames = save_sequences(sequences, answers, is_lure, N, seed, OUTPUT_DIR)
+    if NUM_SEQUENCES == 1:
+        print(np.array(LETTERS)[sequences[0]])
+        print(answers[0])
+    print(f"Saved {len(filenames)} sequences (seed {seed})")
@@ -1,8 +1,16 @@
 #!/usr/bin/env python
 import numpy as np
-import csv
-import speech_recognition as sr
+import soundfile
 import os
+import clip_archive
+import response_clips
+import response_recognition
+import transcription_cache
+import recognition_pool
+import response_matching
+import session_store
+import speech_detection
+import stage_metrics
 
 # The N value in "N-Back" (usually 2)
 N = 2
@@ -13,149 +21,121 @@ REMOVE_CLIPS = []
 # Pause time in seconds
 DELAY = 2.75
 
-# Trial name and name of csv file containing existing results to be modified
+# Trial name (the session store <TRIAL_NAME>_session.npz holds the existing results to be modified)
 TRIAL_NAME = "nback_test1"
-TRIAL_CSV_FILENAME = TRIAL_NAME + ".csv"
-RESULTS_CSV_FILENAME = TRIAL_NAME + "_results.csv"
-CLIP_SEPERATION_PATH = TRIAL_NAME + "_reponse_chunks"
-CHUNK_DIR_NAME = "nback_test1_reponse_chunks"
-
-# Get data from trial csv file
-trial_file = open(TRIAL_CSV_FILENAME)
-trial_reader = csv.reader(trial_file)
-trial_header = next(trial_reader)
-data = []
-for row in trial_reader:
-    if len(row) > 0:
-        data.append(row)
-data = np.array(data)
-
-# Extract necessary data from trial csv file
-letter_index_sequence = np.array(data[:, 1], dtype=int)
-stimuli_time_stamps = np.array(data[:, 3], dtype=float)
-
-# Get data from results csv file
-results_file = open(RESULTS_CSV_FILENAME)
-results_reader = csv.reader(results_file)
-results_header = next(results_reader)
-data = []
-for row in results_reader:
-    if len(row) > 0:
-        data.append(row)
-data = np.array(data)
-
-
-# Extract necessary data from results csv file
-letter_array = np.array(data[:, 0], dtype=str)
-correct_answers = np.array(data[:, 1], dtype=str)
-user_responses = np.array(data[:, 2], dtype=str)
-accuracy_array = np.array(data[:, 3], dtype=str)
-reaction_times = np.array(data[:, 4], dtype=float)
-reaction_on_time = np.array(data[:, 5], dtype=str)
-clip_index_array = np.array(data[:, 6], dtype=int)
-response_timing_markers = np.array(data[:, 9], dtype=float)
-
-# Reformat data in stored arrays
-letter_array = letter_array[letter_array != '-1']
-correct_answers = correct_answers[correct_answers != '-1']
-user_responses = user_responses[user_responses != '-1']
-accuracy_array = accuracy_array[accuracy_array != '-1']
-reaction_times = reaction_times[reaction_times != -1]
-reaction_on_time = reaction_on_time[reaction_on_time != '-1']
-clip_index_array = clip_index_array[clip_index_array != -1]
-response_timing_markers = response_timing_markers[response_timing_markers != -1.0]
-NUM_TESTS = correct_answers.size
-
-# Get the number of clips by counting the nubmer of clips in the folder
-total_num_clips = 0
-dir = CHUNK_DIR_NAME
-for path in os.listdir(dir):
-    if os.path.isfile(os.path.join(dir, path)):
-        total_num_clips += 1
-
-# Get index of the iteration of each corresponding clip in question
-num_remove_clips = len(REMOVE_CLIPS)
-iteration_indices = np.empty(num_remove_clips, dtype=int)
-for i in range(num_remove_clips):
-    iteration_indices[i] = np.where(clip_index_array == REMOVE_CLIPS[i])[0][0]
-clip_iteration_range = tuple(i for i in range(total_num_clips) if i not in REMOVE_CLIPS)
-
-# Init the speech to text recognizer
-r = sr.Recognizer()
-for i in iteration_indices:
-    rt = float('nan')
-    clip_index_array[i] = -9999
-    # Only look for an answer after N number of stimuli have been displayed
-    if i < N or (stimuli_time_stamps[i] > response_timing_markers[-1]):
-        accuracy_array[i] = "N/A"
-        user_responses[i] = "N/A"
-    else:
-        # Determine the most accurate nonsilent chunk that is associated with a given iteration
-        for j in clip_iteration_range:
-            if response_timing_markers[j] > stimuli_time_stamps[i]:
-                # If reaction is too fast, it means the program is considering a delayed response from previous stimulus
-                # Thus, we should continue the loop if that is the case, otherwise, break and store the reaction time
-                if response_timing_markers[j] - stimuli_time_stamps[i] < 0.1 and len(reaction_times) > 0 and \
-                        reaction_times[-1] > (DELAY):
-                    continue
-                rt = response_timing_markers[j] - stimuli_time_stamps[i]
-                break
-        # If there is no nonsilent chunk after the time that the stimulus is displayed, store reaction time as "nan"
-        # Also if the user's response is over 1.6s after the stimulus is displayed, then we know they either failed to
-        # respond or the audio was not recorded and intepreted properly.
-        if j >= len(response_timing_markers) or (rt > (DELAY * 1.2)):
-            reaction_times[i] = float('nan')
-            user_responses[i] = "N/A"
-            accuracy_array[i] = "N/A"
-            continue
-        else:
-            # Save index to clip index array
-            clip_index_array[i] = j
-            # If the response was valid, detemine if it was correct using speech recognition
-            with sr.AudioFile(os.path.join(CLIP_SEPERATION_PATH, f"chunk{j}.wav")) as source:
-                # listen for the data (load audio to memory)
-                audio_data = r.record(source)
-                # recognize (convert from speech to text)
-                try:
-                    resp = (r.recognize_google(audio_data).split()[0]).upper()
-                # If no response can be determined, report accuracies as N/A, store reaction time, and move on
-                except sr.UnknownValueError as err:
-                    accuracy_array[i] = "N/A"
-                    user_responses[i] = "N/A"
-                    reaction_times[i] = rt
-                    continue
-                # compare response from stt to the actual response, update response_accuracies accordingly
-                if (resp[0] == "Y" and (letter_index_sequence[i] == letter_index_sequence[i-N])) or (
-                        resp[0] == "N" and (letter_index_sequence[i] != letter_index_sequence[i-N])):
-                    accuracy_array[i] = "TRUE"
-                else:
-                    accuracy_array[i] = "FALSE"
-                user_responses[i] = resp
-    reaction_times[i] = rt
-
-# Create another array to label each reactiontime according to if it was within the alloted time or not
-reaction_on_time = np.empty(NUM_TESTS, dtype=bool)
-for i in iteration_indices:
-    if len(user_responses[i]) > 0 and user_responses[i] != "N/A" and reaction_times[i] > DELAY:
-        reaction_on_time[i] = False
-    else:
-        reaction_on_time[i] = True
-
-# Write results to file
-with open(TRIAL_NAME + "_RESULTS.csv", 'w') as reac_file:
-    writer = csv.writer(reac_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-    writer.writerow(
-        ['LETTER', 'Correct Answer', 'User response', 'Accuracy (T/F)', 'Reaction time (s)',
-         'Reaction on time (T/F)', 'Clip Index', ' ', ' ', 'Times that user speaks (from start)'])
-    num_rows_in_table = max([len(response_timing_markers), len(correct_answers)])
-    for i in range(num_rows_in_table):
-        if i >= len(response_timing_markers):
-            writer.writerow([letter_array[i], correct_answers[i], user_responses[i], accuracy_array[i],
-                             reaction_times[i], reaction_on_time[i], clip_index_array[i], ' ', ' ', -1.0])
-        elif i >= len(correct_answers):
-            writer.writerow([-1, -1, -1, -1, -1, -1, -1, ' ', ' ', response_timing_markers[i]])
+
+# Which recognizer classifies each response ("google", "template" for the offline classifier, or "fake"),
+# and any options for it (e.g. {"template_file": "response_templates.npz"})
+RECOGNIZER_BACKEND = "google"
+RECOGNIZER_OPTIONS = {}
+
+# File caching recognized responses between runs (None to disable), and the most responses it keeps
+TRANSCRIPTION_CACHE_FILE = "transcription_cache.sqlite"
+TRANSCRIPTION_CACHE_MAX_ENTRIES = 100000
+
+# Save how long each stage took, the most memory it needed and how many items it handled to
+# <TRIAL_NAME>_amend_metrics.json, and whether to also profile with cProfile (to <TRIAL_NAME>_amend_profile.prof)
+WRITE_METRICS = True
+TRACK_MEMORY = True
+PROFILE = False
+
+
+# Re-match the stimuli whose responses were the discarded clips remove_clips to the clips still in clip_dir
+# (<trial_name>_reponse_chunks by default), recognize their new responses and save the amended results to the
+# session store, exporting them as <trial_name>_RESULTS.csv. Returns the amended session.
+def amend_trial(trial_name, remove_clips, n=N, delay=DELAY, clip_dir=None):
+    if clip_dir is None:
+        clip_dir = trial_name + "_reponse_chunks"
+    metrics = stage_metrics.StageMetrics(track_memory=TRACK_MEMORY)
+    with stage_metrics.profiled(trial_name + "_amend_profile.prof" if PROFILE else None):
+        session = amend_stages(trial_name, remove_clips, n, delay, clip_dir, metrics)
+    if WRITE_METRICS:
+        metrics.write_json(trial_name + "_amend_metrics.json")
+    return session
+
+
+# The stages of amend_trial, each timed (and its items counted) in metrics
+def amend_stages(trial_name, remove_clips, n, delay, clip_dir, metrics):
+    with metrics.stage("load"):
+        # Load the stimuli and existing results in one read from the session store
+        session = session_store.load_session(trial_name)
+        letter_sequence = session["letters"]
+        stimuli_time_stamps = session["stimulus_times"]
+        clip_index_array = session["clip_index"].copy()
+        reaction_times = session["reaction_times"].copy()
+        user_responses = session["responses"].astype(object)
+        correct_array = session["correct"].copy()
+        response_timing_markers = session["response_onsets"]
+        num_tests = clip_index_array.size
+
+        # Read the clips from wherever process_nback.py last saved them: its clip archive, one wav each in
+        # clip_dir, or (if it saved neither) straight from the recording
+        archive = None
+        samples = None
+        if clip_archive.uses_clip_archive(trial_name, session):
+            archive = clip_archive.ClipArchive(trial_name)
+        elif not session.get("clip_files", os.path.isdir(clip_dir)):
+            samples, frame_rate, max_amplitude = speech_detection.wav_samples(trial_name + ".wav")
+            clip_bounds = response_clips.clip_bounds(session["chunks"], len(samples) / frame_rate * 1000.0)
+
+    with metrics.stage("match"):
+        # Get index of the iteration of each corresponding clip in question
+        num_remove_clips = len(remove_clips)
+        iteration_indices = np.empty(num_remove_clips, dtype=int)
+        for i in range(num_remove_clips):
+            iteration_indices[i] = np.where(clip_index_array == remove_clips[i])[0][0]
+
+        # Re-match those stimuli, only considering the clips that haven't been discarded
+        clip_mask = np.ones(len(response_timing_markers), dtype=bool)
+        clip_mask[remove_clips] = False
+        new_clip_indices, new_reaction_times = response_matching.match_responses(
+            stimuli_time_stamps[:num_tests], response_timing_markers, n, delay, clip_mask)
+        clip_index_array[iteration_indices] = new_clip_indices[iteration_indices]
+        reaction_times[iteration_indices] = new_reaction_times[iteration_indices]
+        metrics.count("clips_removed", num_remove_clips)
+        metrics.count("stimuli_rematched", np.count_nonzero(new_clip_indices[iteration_indices] >= 0))
+
+    with metrics.stage("recognize"):
+        # Determine whether each newly matched response was correct using speech recognition
+        recognizer = response_recognition.make_recognizer(RECOGNIZER_BACKEND, **RECOGNIZER_OPTIONS)
+        cache = None
+        if TRANSCRIPTION_CACHE_FILE is not None:
+            cache = transcription_cache.TranscriptionCache(TRANSCRIPTION_CACHE_FILE, TRANSCRIPTION_CACHE_MAX_ENTRIES)
+        matched_clip_indices = [j for j in np.unique(clip_index_array[iteration_indices]) if j >= 0]
+        if archive is not None:
+            matched_clips, frame_rate = archive.clips(matched_clip_indices), archive.frame_rate
+        elif samples is not None:
+            matched_clips = {j: response_clips.clip_pcm16(samples, frame_rate, max_amplitude, *clip_bounds[j])
+                             for j in matched_clip_indices}
         else:
-            writer.writerow([letter_array[i], correct_answers[i], user_responses[i], accuracy_array[i],
-                             reaction_times[i], reaction_on_time[i], clip_index_array[i], ' ', ' ',
-                             response_timing_markers[i]])
-print("Done")
+            matched_clips, frame_rate = {}, None
+            for j in matched_clip_indices:
+                matched_clips[j], frame_rate = soundfile.read(os.path.join(clip_dir, f"chunk{j}.wav"),
+                                                              dtype='int16')
+        clip_responses = recognition_pool.recognize_clips(recognizer, matched_clips, frame_rate, cache=cache,
+                                                          metrics=metrics)
+        if cache is not None:
+            print(cache.summary())
+            cache.close()
+
+    with metrics.stage("write"):
+        # Update the responses and accuracies of the re-matched stimuli
+        new_user_responses, new_accuracies = response_matching.score_responses(letter_sequence[:num_tests], n,
+                                                                               clip_index_array, clip_responses)
+        user_responses[iteration_indices] = new_user_responses[iteration_indices]
+        correct_array[iteration_indices] = session_store.accuracies_to_correct(new_accuracies)[iteration_indices]
+        user_responses = np.where(user_responses == "N/A", "", user_responses)
+
+        # Label each reaction time according to if it was within the alloted time or not
+        reaction_on_time = response_matching.reactions_on_time(user_responses, reaction_times, delay)
+
+        # Save the amended results to the session store, and export them as a csv for review
+        session = session_store.save_session(trial_name, clip_index=clip_index_array, reaction_times=reaction_times,
+                                             responses=user_responses, correct=correct_array, on_time=reaction_on_time)
+        session_store.export_results_csv(trial_name, session)
+    return session
+
+
+if __name__ == "__main__":
+    amend_trial(TRIAL_NAME, REMOVE_CLIPS)
+    print("Done")
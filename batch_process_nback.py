@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+import csv
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import clip_archive
+import process_nback
+import response_matching
+import session_store
+
+""" ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~  TUNABLE PARAMETERS    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ """
+# Directory searched (recursively) for trials: a <trial>.wav with its <trial>_session.npz or <trial>.csv
+SESSIONS_DIR = "sessions"
+
+# Number of trials processed at once (defaults to the number of CPU cores)
+BATCH_WORKERS = os.cpu_count()
+
+# Reprocess trials even if their results are newer than their recording and trial csv
+FORCE = False
+
+# Name of the combined summary table written in SESSIONS_DIR
+SUMMARY_CSV_FILENAME = "nback_summary.csv"
+""" ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ """
+
+
+# Find every trial under a directory, as paths without extension (the trial_name given to process_trial).
+# Clip archives written with their index as <trial>_clips.csv look like a trial too, so they are skipped.
+def discover_trials(sessions_dir):
+    trials = []
+    for dirpath, dirnames, filenames in os.walk(sessions_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            name, extension = os.path.splitext(filename)
+            if extension != ".wav":
+                continue
+            has_trial_csv = name + ".csv" in filenames and \
+                not clip_archive.is_clip_index(os.path.join(dirpath, name + ".csv"))
+            if has_trial_csv or name + "_session.npz" in filenames:
+                trials.append(os.path.join(dirpath, name))
+    return trials
+
+
+# Whether a trial's results are newer than its recording and trial csv
+def is_up_to_date(trial_name):
+    results_filename = trial_name + "_RESULTS.csv"
+    if not os.path.isfile(results_filename):
+        return False
+    inputs = [filename for filename in (trial_name + ".csv", trial_name + ".wav") if os.path.isfile(filename)]
+    inputs_mtime = max(os.path.getmtime(filename) for filename in inputs)
+    return os.path.getmtime(results_filename) > inputs_mtime
+
+
+# Process a trial in a worker, timing it and turning any failure into a message so one bad trial can't
+# take the rest of the batch down with it
+def run_trial(trial_name):
+    start = time.perf_counter()
+    try:
+        summary = process_nback.process_trial(trial_name)
+    except Exception as err:
+        return trial_name, None, f"{type(err).__name__}: {err}", time.perf_counter() - start
+    return trial_name, summary, None, time.perf_counter() - start
+
+
+# Process every trial under sessions_dir across a pool of processes and write a combined summary table.
+# Returns the summary rows (one per trial, including skipped and failed trials).
+def process_directory(sessions_dir, max_workers=None, force=False, summary_filename=SUMMARY_CSV_FILENAME):
+    trials = discover_trials(sessions_dir)
+    to_process = [trial for trial in trials if force or not is_up_to_date(trial)]
+    print(f"Found {len(trials)} trials in {sessions_dir}, {len(trials) - len(to_process)} already up to date")
+
+    rows = {}
+    for trial in trials:
+        if trial not in to_process:
+            rows[trial] = session_store.summarize_session(trial, process_nback.N) + ["skipped (up to date)"]
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(run_trial, trial) for trial in to_process]
+        for num_done, future in enumerate(as_completed(futures), start=1):
+            trial, summary, error, elapsed = future.result()
+            if error is None:
+                rows[trial] = summary + ["processed"]
+                print(f"[{num_done}/{len(to_process)}] {trial} done ({elapsed:.1f} s)")
+            else:
+                rows[trial] = [trial] + [''] * (len(response_matching.SUMMARY_HEADER) - 1) + [f"failed: {error}"]
+                print(f"[{num_done}/{len(to_process)}] {trial} FAILED ({error})")
+
+    summary_rows = [rows[trial] for trial in trials]
+    with open(os.path.join(sessions_dir, summary_filename), 'w') as summary_file:
+        writer = csv.writer(summary_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(response_matching.SUMMARY_HEADER + ['Status'])
+        writer.writerows(summary_rows)
+    return summary_rows
+
+
+if __name__ == "__main__":
+    summary_rows = process_directory(SESSIONS_DIR, max_workers=BATCH_WORKERS, force=FORCE)
+    num_failed = sum(1 for row in summary_rows if row[-1].startswith("failed"))
+    print(f"Done ({num_failed} failed)")
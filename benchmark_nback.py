@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+import csv
+import json
+import os
+import numpy as np
+import process_nback
+import session_store
+import synthetic_session
+
+""" ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~  TUNABLE PARAMETERS    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ """
+# Lengths (minutes) of the synthesized sessions the pipeline is timed on
+SESSION_MINUTES = [1, 5, 15, 30, 60, 120]
+
+# Directory the synthesized sessions are kept in (they are only synthesized again if missing)
+BENCHMARK_DIR = "benchmark_sessions"
+
+# A detected response within this long (s) of a true response onset counts as finding it
+ONSET_TOLERANCE_S = 0.25
+
+# Recognizer the responses are classified with (the "fake" one needs no network or trained templates)
+RECOGNIZER_BACKEND = "fake"
+
+# File the timings and detection errors are written to (in BENCHMARK_DIR)
+BENCHMARK_CSV_FILENAME = "benchmark_results.csv"
+""" ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ """
+
+# Stages of process_nback.process_trial, in order
+STAGES = ['load', 'detect', 'clip', 'match', 'recognize', 'write']
+
+# Columns of the rows returned by benchmark_session
+BENCHMARK_HEADER = ['Session (min)', 'Stimuli'] + [f'{stage} (s)' for stage in STAGES] + \
+                   ['Total (s)', 'Peak memory (MB)', 'True responses', 'Responses detected', 'Responses found',
+                    'Responses missed', 'False detections', 'Mean onset error (ms)', 'Mean absolute onset error (ms)']
+
+
+# Compare detected response onsets against the true ones: each true onset is found by the nearest detected
+# onset within tolerance_s. Returns (found, missed, false detections, mean error (ms), mean absolute error (ms)).
+def onset_errors(detected, truth, tolerance_s=ONSET_TOLERANCE_S):
+    detected = np.asarray(detected, dtype=np.float64)
+    truth = np.asarray(truth, dtype=np.float64)
+    if len(detected) == 0 or len(truth) == 0:
+        return 0, len(truth), len(detected), float('nan'), float('nan')
+    right = np.clip(np.searchsorted(detected, truth), 0, len(detected) - 1)
+    left = np.clip(right - 1, 0, len(detected) - 1)
+    nearest = np.where(np.abs(detected[left] - truth) <= np.abs(detected[right] - truth), left, right)
+    errors = detected[nearest] - truth
+    found = np.abs(errors) <= tolerance_s
+    num_found = int(np.count_nonzero(found))
+    num_false = len(detected) - len(np.unique(nearest[found]))
+    mean_error = float(np.mean(errors[found]) * 1000.0) if num_found else float('nan')
+    mean_abs_error = float(np.mean(np.abs(errors[found])) * 1000.0) if num_found else float('nan')
+    return num_found, len(truth) - num_found, num_false, mean_error, mean_abs_error
+
+
+# Run process_nback.process_trial on one trial with its settings, apart from scoring every stimulus in the
+# session, recognizing responses with RECOGNIZER_BACKEND and not using the transcription cache (so every run
+# recognizes every clip), and read back how long each stage took from the metrics it saves. Returns (metrics,
+# detected onsets).
+def time_stages(trial_name):
+    settings = {"NUM_TESTS": len(session_store.load_session(trial_name)["letters"]),
+                "RECOGNIZER_BACKEND": RECOGNIZER_BACKEND, "RECOGNIZER_OPTIONS": {}, "TRANSCRIPTION_CACHE_FILE": None,
+                "WRITE_METRICS": True}
+    saved_settings = {name: getattr(process_nback, name) for name in settings}
+    try:
+        for name, value in settings.items():
+            setattr(process_nback, name, value)
+        process_nback.process_trial(trial_name)
+    finally:
+        for name, value in saved_settings.items():
+            setattr(process_nback, name, value)
+    with open(trial_name + "_metrics.json") as metrics_file:
+        metrics = json.load(metrics_file)
+    return metrics, session_store.load_session(trial_name)["response_onsets"]
+
+
+# Synthesize (if needed) and time a session of the given length. Returns a row of BENCHMARK_HEADER.
+def benchmark_session(minutes, benchmark_dir=BENCHMARK_DIR):
+    trial_name = os.path.join(benchmark_dir, f"synthetic_{minutes:g}min")
+    if not (os.path.isfile(trial_name + ".wav") and os.path.isfile(session_store.session_filename(trial_name))):
+        synthetic_session.synthesize_session(trial_name, minutes=minutes, n=process_nback.N,
+                                             stimulus_interval_s=process_nback.STIMULUS_INTERVAL_S,
+                                             interial_interval_s=process_nback.INTERIAL_INTERVAL_S)
+    metrics, detected = time_stages(trial_name)
+    timings = {record["stage"]: record["wall_s"] for record in metrics["stages"]}
+    peak_memory_mb = max((record.get("peak_memory_mb", float('nan')) for record in metrics["stages"]),
+                         default=float('nan'))
+    session = session_store.load_session(trial_name)
+    truth = session["synthetic_onsets"]
+    return [minutes, len(session["letters"])] + [timings[stage] for stage in STAGES] + \
+        [metrics["total_s"], peak_memory_mb, len(truth), len(detected)] + list(onset_errors(detected, truth))
+
+
+if __name__ == "__main__":
+    if not os.path.isdir(BENCHMARK_DIR):
+        os.makedirs(BENCHMARK_DIR)
+    rows = []
+    for minutes in SESSION_MINUTES:
+        rows.append(benchmark_session(minutes))
+        print("%g min: " % minutes + ", ".join(f"{stage} {rows[-1][2 + i]:.2f} s" for i, stage in enumerate(STAGES)) +
+              f"; peak memory {rows[-1][-8]:.0f} MB; {rows[-1][-5]}/{rows[-1][-7]} responses found, "
+              f"mean absolute onset error {rows[-1][-1]:.1f} ms")
+    with open(os.path.join(BENCHMARK_DIR, BENCHMARK_CSV_FILENAME), 'w') as benchmark_file:
+        writer = csv.writer(benchmark_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(BENCHMARK_HEADER)
+        writer.writerows(rows)
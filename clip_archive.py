@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+import csv
+import os
+import numpy as np
+import soundfile
+import response_clips
+import session_store
+import speech_detection
+
+""" ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~  TUNABLE PARAMETERS    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ """
+# Trial whose clip archive is exported to individual wavs (in <TRIAL_NAME>_reponse_chunks) when this is run
+TRIAL_NAME = "nback_test"
+""" ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ """
+
+# Columns of the index: where each clip's samples are in the archive, and which part of the recording (ms)
+# it was cut from
+CLIP_INDEX_HEADER = ['Clip', 'Offset (samples)', 'Length (samples)', 'Start (ms)', 'End (ms)']
+
+
+# The archive of a trial's response clips: every clip back to back as one mono 16-bit wav, plus a csv index.
+# The index isn't named <trial>_clips.csv so the archive can't be mistaken for a trial of its own; archives
+# written before that still have their index read from there.
+def archive_filenames(trial_name):
+    index_filename = trial_name + "_clips_index.csv"
+    if not os.path.isfile(index_filename) and os.path.isfile(trial_name + "_clips.csv"):
+        index_filename = trial_name + "_clips.csv"
+    return trial_name + "_clips.wav", index_filename
+
+
+# Whether a csv is the index of a clip archive (rather than a trial's csv)
+def is_clip_index(csv_filename):
+    with open(csv_filename, newline='') as csv_file:
+        return next(csv.reader(csv_file), None) == CLIP_INDEX_HEADER
+
+
+def has_clip_archive(trial_name):
+    return all(os.path.isfile(filename) for filename in archive_filenames(trial_name))
+
+
+# Whether a trial's clips should be read from its archive rather than from one wav each. The session store
+# records which of the two process_nback.py saved last, so an archive left over from an earlier run is never
+# read; only sessions processed before that was recorded go by whether an archive exists.
+def uses_clip_archive(trial_name, session=None):
+    if session is None and os.path.isfile(session_store.session_filename(trial_name)):
+        session = session_store.load_session(trial_name)
+    if session is not None and "clip_archive" in session:
+        return bool(session["clip_archive"])
+    return has_clip_archive(trial_name)
+
+
+# Cut the clip for every (start, end) in clip_bounds (ms) out of the recording and write them all to one
+# archive, instead of one wav per clip. Clips are written as they are cut, so only one is in memory at a time.
+def write_clip_archive(trial_name, samples, frame_rate, max_amplitude, clip_bounds):
+    archive_filename, index_filename = trial_name + "_clips.wav", trial_name + "_clips_index.csv"
+    rows = []
+    offset = 0
+    with soundfile.SoundFile(archive_filename, mode='w', samplerate=frame_rate, channels=1,
+                             subtype='PCM_16') as archive_file:
+        for i in range(len(clip_bounds)):
+            clip = response_clips.clip_pcm16(samples, frame_rate, max_amplitude, *clip_bounds[i])
+            archive_file.write(clip)
+            rows.append([i, offset, len(clip), clip_bounds[i][0], clip_bounds[i][1]])
+            offset += len(clip)
+    with open(index_filename, 'w') as index_file:
+        writer = csv.writer(index_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(CLIP_INDEX_HEADER)
+        writer.writerows(rows)
+
+
+# A trial's clip archive opened for random access: the archive is memory-mapped, so reading a clip only
+# reads that clip's samples from disk
+class ClipArchive:
+    def __init__(self, trial_name):
+        archive_filename, index_filename = archive_filenames(trial_name)
+        samples, self.frame_rate, max_amplitude = speech_detection.wav_samples(archive_filename)
+        self.samples = samples[:, 0]
+        with open(index_filename) as index_file:
+            reader = csv.reader(index_file)
+            header = next(reader)
+            index = np.array([[float(value) for value in row] for row in reader if len(row) > 0]).reshape(-1, 5)
+        self.offsets = index[:, 1].astype(np.int64)
+        self.lengths = index[:, 2].astype(np.int64)
+        self.bounds = index[:, 3:5]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    # The 16-bit PCM samples of clip i
+    def clip(self, i):
+        return np.array(self.samples[self.offsets[i]:self.offsets[i] + self.lengths[i]])
+
+    # {clip index: samples} for the given clips, as recognition_pool.recognize_clips takes them
+    def clips(self, indices):
+        return {j: self.clip(j) for j in indices}
+
+
+# Write every clip in a trial's archive to its own wav (chunk<i>.wav, as process_nback.py names them) so a
+# reviewer can listen to them one by one. Returns the number of clips written.
+def export_wavs(trial_name, clip_dir=None):
+    if clip_dir is None:
+        clip_dir = trial_name + "_reponse_chunks"
+    if not os.path.isdir(clip_dir):
+        os.mkdir(clip_dir)
+    archive = ClipArchive(trial_name)
+    for i in range(len(archive)):
+        response_clips.write_clip(os.path.join(clip_dir, f"chunk{i}.wav"), archive.clip(i), archive.frame_rate)
+    return len(archive)
+
+
+if __name__ == "__main__":
+    num_clips = export_wavs(TRIAL_NAME)
+    print(f"Exported {num_clips} clips to {TRIAL_NAME}_reponse_chunks")
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+import csv
+import os
+import time
+import numpy as np
+from scipy.stats import norm
+import clip_archive
+import process_nback
+import session_store
+
+""" ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~  TUNABLE PARAMETERS    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ """
+# Directory searched (recursively) for processed trials (<trial>_RESULTS.csv)
+SESSIONS_DIR = "sessions"
+
+# Group sessions by the directory they are in (one directory per subject) instead of treating every trial
+# as its own subject
+SUBJECT_FROM_DIRECTORY = False
+
+# N of trials without a session store to read it from
+DEFAULT_N = process_nback.N
+
+# Index of the results already parsed, and the cohort summary table (both written in SESSIONS_DIR)
+INDEX_FILENAME = "nback_cohort_index.npz"
+COHORT_CSV_FILENAME = "nback_cohort.csv"
+""" ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ """
+
+# Bumped whenever the fields of the index change, so an old index is rebuilt rather than misread
+INDEX_VERSION = 1
+
+# Per-session fields of the index, and per-stimulus fields (every session's stimuli back to back)
+SESSION_FIELDS = {"paths": str, "mtimes": np.float64, "subjects": str, "n": np.int64, "lengths": np.int64}
+STIMULUS_FIELDS = {"target": bool, "said_yes": bool, "scored": bool, "reaction_times": np.float64,
+                   "on_time": bool}
+
+# Columns of the cohort summary table
+COHORT_HEADER = ['Subject', 'N', 'Sessions', 'Stimuli scored', 'Targets', 'Hits', 'False alarms', 'Hit rate',
+                 'False alarm rate', "d'", 'Median reaction time (s)', 'On time (%)']
+
+
+# Find every results table under a directory, with the time each was last modified. Results of a clip archive
+# that was once processed as if it were a trial (see batch_process_nback.discover_trials) are left out.
+def discover_results(sessions_dir):
+    results = {}
+    for dirpath, dirnames, filenames in os.walk(sessions_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith("_RESULTS.csv"):
+                trial_csv = filename[:-len("_RESULTS.csv")] + ".csv"
+                if trial_csv in filenames and clip_archive.is_clip_index(os.path.join(dirpath, trial_csv)):
+                    continue
+                path = os.path.join(dirpath, filename)
+                results[path] = os.path.getmtime(path)
+    return results
+
+
+# Which subject a results table belongs to: the directory it is in, or its trial (with its directory, so
+# same-named trials in different directories stay apart), relative to sessions_dir
+def subject_name(results_path, sessions_dir, subject_from_directory=SUBJECT_FROM_DIRECTORY):
+    if subject_from_directory:
+        return os.path.relpath(os.path.dirname(results_path), sessions_dir)
+    return os.path.relpath(results_path, sessions_dir)[:-len("_RESULTS.csv")]
+
+
+# Read one results table into the per-stimulus fields of the index. Targets are worked out from the letters
+# (as response_matching.score_responses does), a response counts as "yes" if it starts with Y, and the
+# first n stimuli, which have nothing to compare against, are not scored. Returns (n, fields).
+def parse_results(results_path, default_n=DEFAULT_N):
+    trial_name = results_path[:-len("_RESULTS.csv")]
+    n = default_n
+    if os.path.isfile(session_store.session_filename(trial_name)):
+        n = int(session_store.load_session(trial_name).get("n", default_n))
+
+    letters, responses, reaction_times, on_time = [], [], [], []
+    with open(results_path) as results_file:
+        reader = csv.reader(results_file)
+        header = next(reader)
+        for row in reader:
+            # Rows of -1 only list the responses left over after the last stimulus
+            if len(row) < 6 or row[0] == "-1":
+                break
+            letters.append(row[0])
+            responses.append(row[2])
+            reaction_times.append(row[4])
+            on_time.append(row[5])
+
+    letters = np.array(letters, dtype=str)
+    target = np.zeros(len(letters), dtype=bool)
+    target[n:] = letters[n:] == letters[:len(letters) - n]
+    said_yes = np.char.startswith(np.char.upper(np.array(responses, dtype=str)), "Y")
+    return n, {"target": target, "said_yes": said_yes, "scored": np.arange(len(letters)) >= n,
+               "reaction_times": np.array(reaction_times, dtype=np.float64),
+               "on_time": np.array(on_time, dtype=str) == "True"}
+
+
+# An index with no sessions in it
+def empty_index():
+    index = {name: np.empty(0, dtype=dtype) for name, dtype in SESSION_FIELDS.items()}
+    index.update({name: np.empty(0, dtype=dtype) for name, dtype in STIMULUS_FIELDS.items()})
+    return index
+
+
+# Load the index of parsed results (an empty one if there is none yet, or it was written by an older version)
+def load_index(filename):
+    if not os.path.isfile(filename):
+        return empty_index()
+    with np.load(filename) as data:
+        if "version" not in data or int(data["version"]) != INDEX_VERSION:
+            return empty_index()
+        return {name: data[name] for name in list(SESSION_FIELDS) + list(STIMULUS_FIELDS)}
+
+
+# Write the index to a temporary file first so an interrupted run never leaves a half-written one
+def save_index(filename, index):
+    temp_filename = filename[:-len(".npz")] + ".tmp.npz"
+    np.savez(temp_filename, version=INDEX_VERSION, **index)
+    os.replace(temp_filename, filename)
+
+
+# Bring the index up to date with the results tables under sessions_dir: tables whose modification time is
+# unchanged are taken from the index as they are, new and changed ones are parsed, and deleted ones dropped.
+# Returns (index, number of tables parsed).
+def update_index(index, sessions_dir, default_n=DEFAULT_N, subject_from_directory=SUBJECT_FROM_DIRECTORY):
+    results = discover_results(sessions_dir)
+    starts = np.concatenate(([0], np.cumsum(index["lengths"])))
+    indexed = {path: i for i, path in enumerate(index["paths"])}
+
+    sessions = {name: [] for name in SESSION_FIELDS}
+    stimuli = {name: [] for name in STIMULUS_FIELDS}
+    num_parsed = 0
+    for path, mtime in results.items():
+        i = indexed.get(path)
+        if i is not None and index["mtimes"][i] == mtime:
+            n = int(index["n"][i])
+            fields = {name: index[name][starts[i]:starts[i + 1]] for name in STIMULUS_FIELDS}
+        else:
+            n, fields = parse_results(path, default_n)
+            num_parsed += 1
+        sessions["paths"].append(path)
+        sessions["mtimes"].append(mtime)
+        sessions["subjects"].append(subject_name(path, sessions_dir, subject_from_directory))
+        sessions["n"].append(n)
+        sessions["lengths"].append(len(fields["target"]))
+        for name in STIMULUS_FIELDS:
+            stimuli[name].append(fields[name])
+
+    updated = {name: np.array(values, dtype=SESSION_FIELDS[name]).reshape(-1) for name, values in sessions.items()}
+    updated.update({name: np.concatenate(values).astype(STIMULUS_FIELDS[name]) if values else
+                    np.empty(0, dtype=STIMULUS_FIELDS[name]) for name, values in stimuli.items()})
+    return updated, num_parsed
+
+
+# Median of the values in each group (nan for groups without any), from one sort of all of them
+def grouped_median(values, groups, num_groups):
+    order = np.lexsort((values, groups))
+    values, groups = values[order], groups[order]
+    counts = np.bincount(groups, minlength=num_groups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    medians = np.full(num_groups, np.nan)
+    has_values = counts > 0
+    lower = starts[has_values] + (counts[has_values] - 1) // 2
+    upper = starts[has_values] + counts[has_values] // 2
+    medians[has_values] = (values[lower] + values[upper]) / 2.0
+    return medians
+
+
+# Hit rate, false alarm rate, d', median reaction time and on-time percentage for every group of sessions
+# at once (session_groups gives each session's group). d' uses the log-linear correction (half a hit and half
+# a false alarm are added) so that rates of 0 or 1 still give a finite value. Reaction times and on-time
+# percentages are over every stimulus with a matched response, as in response_matching.summarize_trial.
+# Returns one row per group: [sessions, stimuli scored, targets, hits, false alarms, rates..., d', RT, on time].
+def group_metrics(index, session_groups, num_groups):
+    groups = np.repeat(session_groups, index["lengths"])
+    scored = index["scored"]
+    target = scored & index["target"]
+    non_target = scored & ~index["target"]
+    said_yes = index["said_yes"]
+
+    num_sessions = np.bincount(session_groups, minlength=num_groups)
+    num_scored = np.bincount(groups, weights=scored, minlength=num_groups)
+    num_targets = np.bincount(groups, weights=target, minlength=num_groups)
+    num_non_targets = np.bincount(groups, weights=non_target, minlength=num_groups)
+    hits = np.bincount(groups, weights=target & said_yes, minlength=num_groups)
+    false_alarms = np.bincount(groups, weights=non_target & said_yes, minlength=num_groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hit_rate = hits / num_targets
+        false_alarm_rate = false_alarms / num_non_targets
+    d_prime = norm.ppf((hits + 0.5) / (num_targets + 1)) - norm.ppf((false_alarms + 0.5) / (num_non_targets + 1))
+
+    matched = ~np.isnan(index["reaction_times"])
+    median_rt = grouped_median(index["reaction_times"][matched], groups[matched], num_groups)
+    num_matched = np.bincount(groups, weights=matched, minlength=num_groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        on_time = 100.0 * np.bincount(groups, weights=matched & index["on_time"], minlength=num_groups) / num_matched
+
+    return np.column_stack((num_sessions, num_scored, num_targets, hits, false_alarms, hit_rate,
+                            false_alarm_rate, d_prime, median_rt, on_time))
+
+
+# Rows of COHORT_HEADER: one per subject and N, then one per N over every subject
+def cohort_summary(index):
+    rows = []
+    subject_n, session_groups = np.unique(np.rec.fromarrays((index["subjects"], index["n"])), return_inverse=True)
+    for (subject, n), metrics in zip(subject_n, group_metrics(index, session_groups.ravel(), len(subject_n))):
+        rows.append([str(subject), int(n)] + [int(value) for value in metrics[:5]] + list(metrics[5:]))
+    all_n, session_groups = np.unique(index["n"], return_inverse=True)
+    for n, metrics in zip(all_n, group_metrics(index, session_groups.ravel(), len(all_n))):
+        rows.append(["All subjects", int(n)] + [int(value) for value in metrics[:5]] + list(metrics[5:]))
+    return rows
+
+
+# Update the index of sessions_dir's results and write the cohort summary there. Returns the summary rows.
+def analyze_cohort(sessions_dir, default_n=DEFAULT_N, subject_from_directory=SUBJECT_FROM_DIRECTORY,
+                   index_filename=INDEX_FILENAME, cohort_filename=COHORT_CSV_FILENAME):
+    start = time.perf_counter()
+    index_path = os.path.join(sessions_dir, index_filename)
+    index, num_parsed = update_index(load_index(index_path), sessions_dir, default_n, subject_from_directory)
+    save_index(index_path, index)
+    rows = cohort_summary(index)
+    with open(os.path.join(sessions_dir, cohort_filename), 'w') as cohort_file:
+        writer = csv.writer(cohort_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(COHORT_HEADER)
+        writer.writerows(rows)
+    print(f"Summarized {len(index['paths'])} sessions in {sessions_dir} ({num_parsed} parsed, "
+          f"{len(index['paths']) - num_parsed} from the index) in {time.perf_counter() - start:.2f} s")
+    return rows
+
+
+if __name__ == "__main__":
+    analyze_cohort(SESSIONS_DIR)
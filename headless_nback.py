@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+import time
+import numpy as np
+from scipy.io import loadmat
+import run_nback
+import stimulus_scheduler
+
+""" ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~  TUNABLE PARAMETERS    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ """
+# Trial the simulated session is saved as (None to not save it)
+TRIAL_NAME = "headless_test"
+
+# Sequence and number of stimuli to present (as in run_nback.py)
+MAT_FILE_NAME = run_nback.MAT_FILE_NAME
+N = run_nback.N
+NUM_TESTS = run_nback.NUM_TESTS
+
+# How long (s) drawing a frame takes on the virtual display, and the resolution of the simulated clock (s)
+RENDER_S = 0.008
+CLOCK_TICK_S = 0.0001
+""" ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ """
+
+
+# A clock that only moves when slept on (or, by tick_s, whenever it is read, so busy-waiting on it ends)
+class SimulatedClock:
+    def __init__(self, tick_s=CLOCK_TICK_S):
+        self.time = 0.0
+        self.tick_s = tick_s
+
+    def __call__(self):
+        self.time += self.tick_s
+        return self.time
+
+    def sleep(self, seconds):
+        self.time += max(seconds, 0.0)
+
+
+# Stands in for run_nback.ProjectorDisplay: drawing takes render_s of simulated time, and every frame shown is
+# recorded with the time it appeared
+class VirtualDisplay:
+    def __init__(self, clock, width=1920, height=1080, render_s=RENDER_S):
+        self.clock = clock
+        self.width = width
+        self.height = height
+        self.render_s = render_s
+        self.shown = []
+
+    def frame_cache(self):
+        return TextFrames()
+
+    def show(self, image):
+        self.clock.sleep(self.render_s)
+        self.shown.append((self.clock.time, image))
+
+    def close(self):
+        pass
+
+
+# Stands in for stimulus_frames.FrameCache without rendering anything: each "frame" is just its text
+class TextFrames:
+    def get(self, text, font_scale, thickness):
+        return text
+
+    def sequence_frames(self, letter_sequence, font_scale, thickness):
+        letters, frame_indices = np.unique(np.asarray(letter_sequence, dtype=str), return_inverse=True)
+        return [str(letter) for letter in letters], frame_indices.ravel()
+
+
+# Run the whole presentation of run_nback.py (countdown and stimuli) on a virtual display against a simulated
+# clock, so a session takes milliseconds instead of minutes. Saves it as trial_name (unless None), like
+# run_nback.py would apart from the recording. Returns the scheduler (holding the intended and actual onsets)
+# and the display (holding every frame shown).
+def run_headless(trial_name=TRIAL_NAME, mat_file_name=MAT_FILE_NAME, n=N, num_tests=NUM_TESTS, render_s=RENDER_S,
+                 stimulus_interval_s=run_nback.STIMULUS_INTERVAL_S, interial_interval_s=run_nback.INTERIAL_INTERVAL_S):
+    mat = loadmat(mat_file_name)
+    letter_sequence = np.resize(mat["Sequence"], num_tests)
+    answer_array = np.resize(mat["Answers"], num_tests)
+
+    clock = SimulatedClock()
+    display = VirtualDisplay(clock, render_s=render_s)
+    frame_cache = display.frame_cache()
+    stimuli_images, stimuli_frame_indices = frame_cache.sequence_frames(letter_sequence, run_nback.fontScale,
+                                                                        run_nback.fontThickness)
+    run_nback.countdown(display, frame_cache, sleep=clock.sleep)
+    scheduler = stimulus_scheduler.StimulusScheduler(clock=clock, sleep=clock.sleep, spin_s=0.0)
+    run_nback.present_stimuli(display, stimuli_images, stimuli_frame_indices, "", scheduler, num_tests,
+                              stimulus_interval_s, interial_interval_s)
+    display.close()
+    if trial_name is not None:
+        run_nback.save_presentation(trial_name, n, letter_sequence, answer_array, scheduler,
+                                    response_window_s=stimulus_interval_s + interial_interval_s)
+    return scheduler, display
+
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    scheduler, display = run_headless()
+    elapsed = time.perf_counter() - start
+    print(f"Presented {len(scheduler.actual)} stimuli ({display.clock.time:.1f} s of simulated time, "
+          f"{len(display.shown)} frames) in {elapsed * 1000.0:.1f} ms")
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+import collections
+import os
+import numpy as np
+import response_clips
+
+
+# Incremental version of speech_detection.detect_nonsilent that is fed the recording one block at a time.
+# The energy of every millisecond is kept just long enough to measure the min_silence_len windows that
+# start in it, so each block costs time proportional to its length.
+#
+# process_nback uses the level of the whole recording as the silence threshold, i.e. a window is silent if
+# its RMS is at most the RMS of the whole recording. Live, the RMS of the recording so far is used instead
+# (offset by relative_threshold_db). Early on, before the user has said much, that is barely above the
+# background noise, so the threshold is also kept at least noise_margin_db above the noise floor (the 10th
+# percentile of the window levels seen so far).
+class StreamingOnsetDetector:
+    def __init__(self, frame_rate, min_silence_len=500, relative_threshold_db=0.0, noise_margin_db=6.0,
+                 on_onset=None, on_chunk=None):
+        self.frame_rate = frame_rate
+        self.min_silence_len = min_silence_len
+        self.threshold_ratio = 10 ** (relative_threshold_db / 20.0)
+        self.noise_margin_db = noise_margin_db
+        # Histogram of window levels in 1 dB steps from -150 to 0 dBFS, for tracking the noise floor
+        self.level_counts = np.zeros(151, dtype=np.int64)
+        # Called with the onset (ms) of a response as soon as it is known, and with (start_ms, end_ms) once the
+        # response has ended
+        self.on_onset = on_onset
+        self.on_chunk = on_chunk
+
+        self.frames_seen = 0
+        self.total_energy = 0.0
+        self.total_samples = 0
+        # Energy and sample count of each millisecond from first_ms onwards
+        self.first_ms = 0
+        self.ms_energy = np.zeros(0)
+        self.ms_samples = np.zeros(0, dtype=np.int64)
+        # Start (ms) of the next window to be measured, and of the last window found to be silent (a silent
+        # window just before the recording is assumed, so speech at the very start is still a response)
+        self.next_window = 0
+        self.prev_silent = -min_silence_len
+        self.onset_reported = False
+        self.onsets = []
+        self.chunks = []
+
+    # Feed the next block of samples (frames, or frames x channels)
+    def process(self, block):
+        block = np.asarray(block, dtype=np.float64)
+        if block.ndim == 1:
+            block = block[:, np.newaxis]
+        num_frames, num_channels = block.shape
+        if num_frames == 0:
+            return
+        squares = np.square(block).sum(axis=1)
+        self.total_energy += squares.sum()
+        self.total_samples += num_frames * num_channels
+
+        # Add each frame's energy to the millisecond it falls in
+        frame_ms = (np.arange(self.frames_seen, self.frames_seen + num_frames) * 1000) // self.frame_rate
+        self.frames_seen += num_frames
+        size = int(frame_ms[-1]) - self.first_ms + 1
+        if size > len(self.ms_energy):
+            self.ms_energy = np.concatenate((self.ms_energy, np.zeros(size - len(self.ms_energy))))
+            self.ms_samples = np.concatenate((self.ms_samples, np.zeros(size - len(self.ms_samples), dtype=np.int64)))
+        offsets = frame_ms - self.first_ms
+        self.ms_energy += np.bincount(offsets, weights=squares, minlength=size)[:len(self.ms_energy)]
+        self.ms_samples += np.bincount(offsets, minlength=size)[:len(self.ms_samples)] * num_channels
+
+        # Measure every window whose milliseconds are all complete
+        complete_ms = (self.frames_seen * 1000) // self.frame_rate
+        last_window = complete_ms - self.min_silence_len
+        if last_window < self.next_window:
+            return
+        starts = np.arange(self.next_window, last_window + 1)
+        energy = np.concatenate(([0.0], np.cumsum(self.ms_energy)))
+        samples = np.concatenate(([0], np.cumsum(self.ms_samples)))
+        lo = starts - self.first_ms
+        hi = lo + self.min_silence_len
+        rms = np.sqrt((energy[hi] - energy[lo]) / np.maximum(samples[hi] - samples[lo], 1))
+        levels = np.clip(np.round(20 * np.log10(np.maximum(rms, 1e-10))), -150, 0).astype(int)
+        self.level_counts += np.bincount(levels + 150, minlength=len(self.level_counts))
+        self._update(starts, rms <= self.threshold(), last_window)
+
+        # Forget the milliseconds no longer needed for any window
+        self.next_window = last_window + 1
+        drop = self.next_window - self.first_ms
+        self.ms_energy = self.ms_energy[drop:]
+        self.ms_samples = self.ms_samples[drop:]
+        self.first_ms = self.next_window
+
+    # RMS at or below which a window counts as silent
+    def threshold(self):
+        cumulative_counts = np.cumsum(self.level_counts)
+        noise_floor_db = np.searchsorted(cumulative_counts, 0.1 * cumulative_counts[-1]) - 150
+        return max(np.sqrt(self.total_energy / self.total_samples) * self.threshold_ratio,
+                   10 ** ((noise_floor_db + self.noise_margin_db) / 20.0))
+
+    # Turn newly measured windows into onsets and chunks, following the same rule as detect_silence: silent
+    # windows less than min_silence_len apart belong to the same silence
+    def _update(self, starts, silent, last_window):
+        for silent_start in starts[silent]:
+            if silent_start - self.prev_silent > self.min_silence_len:
+                self._report_onset()
+                self._report_chunk(self.prev_silent + self.min_silence_len, int(silent_start))
+            self.prev_silent = int(silent_start)
+            self.onset_reported = False
+        # Once a full window of non-silence has passed, the response has definitely started
+        if last_window - self.prev_silent > self.min_silence_len:
+            self._report_onset()
+
+    def _report_onset(self):
+        if not self.onset_reported:
+            onset = self.prev_silent + self.min_silence_len
+            self.onsets.append(onset)
+            self.onset_reported = True
+            if self.on_onset is not None:
+                self.on_onset(onset)
+
+    def _report_chunk(self, start, end):
+        if start == 0 and end == 0:
+            return
+        self.chunks.append((start, end))
+        if self.on_chunk is not None:
+            self.on_chunk(start, end)
+
+    # Call once the recording has ended; closes a response that is still going
+    def finish(self):
+        total_ms = int(round(1000.0 * self.frames_seen / self.frame_rate))
+        if total_ms - self.prev_silent > self.min_silence_len:
+            self._report_onset()
+            self._report_chunk(self.prev_silent + self.min_silence_len, total_ms)
+        return np.array(self.chunks, dtype=np.int64).reshape(-1, 2)
+
+
+# Runs a StreamingOnsetDetector on every block a streaming_recorder.StreamingRecorder saves (pass its process
+# method as the recorder's on_block). Optionally writes each response to <clip_dir>/chunk{i}.wav as soon as
+# it ends, keeping only the last history_s seconds of audio around to cut them from.
+class LiveDetector:
+    def __init__(self, sample_rate, min_silence_len=500, relative_threshold_db=0.0, noise_margin_db=6.0,
+                 clip_dir=None, clip_padding_ms=response_clips.CLIP_PADDING_MS, history_s=10.0, verbose=True):
+        self.sample_rate = sample_rate
+        self.clip_dir = clip_dir
+        self.clip_padding_ms = clip_padding_ms
+        self.history_frames = int(history_s * sample_rate)
+        self.verbose = verbose
+        # Recent blocks, and the frame each one starts at
+        self.blocks = collections.deque()
+        self.block_starts = collections.deque()
+        self.pending_clips = []
+        self.num_clips = 0
+        self.detector = StreamingOnsetDetector(sample_rate, min_silence_len, relative_threshold_db, noise_margin_db,
+                                               on_onset=self._on_onset, on_chunk=self._on_chunk)
+        if clip_dir is not None and not os.path.isdir(clip_dir):
+            os.mkdir(clip_dir)
+
+    def process(self, block):
+        if self.clip_dir is not None:
+            self.block_starts.append(self.detector.frames_seen)
+            self.blocks.append(np.array(block))
+            # Forget audio too old to be part of any clip still to be written
+            while self.block_starts and self.detector.frames_seen - self.block_starts[0] > self.history_frames:
+                self.blocks.popleft()
+                self.block_starts.popleft()
+        self.detector.process(block)
+        self._write_ready_clips()
+
+    def _on_onset(self, onset_ms):
+        if self.verbose:
+            print(f"Response detected at {onset_ms / 1000.0:.3f} s")
+
+    def _on_chunk(self, start_ms, end_ms):
+        if self.clip_dir is not None:
+            self.pending_clips.append((start_ms, end_ms))
+
+    # Write the clips whose padded end has been recorded
+    def _write_ready_clips(self, final=False):
+        recorded_ms = 1000.0 * self.detector.frames_seen / self.sample_rate
+        while self.pending_clips:
+            start_ms, end_ms = self.pending_clips[0]
+            if not final and end_ms + self.clip_padding_ms > recorded_ms:
+                break
+            self.pending_clips.pop(0)
+            if not self.blocks:
+                continue
+            start, end = response_clips.clip_bounds([[start_ms, end_ms]], recorded_ms, self.clip_padding_ms)[0]
+            # Cut the clip out of the recent audio (anything older than the history is left out)
+            offset_ms = 1000.0 * self.block_starts[0] / self.sample_rate
+            audio = np.concatenate(self.blocks)
+            clip = response_clips.clip_pcm16(audio, self.sample_rate, 1.0, max(start - offset_ms, 0),
+                                             max(end - offset_ms, 0))
+            response_clips.write_clip(os.path.join(self.clip_dir, f"chunk{self.num_clips}.wav"), clip,
+                                      self.sample_rate)
+            self.num_clips += 1
+
+    # Call once the recording has ended. Returns the (start_ms, end_ms) of every response
+    def finish(self):
+        chunks = self.detector.finish()
+        if self.clip_dir is not None:
+            self._write_ready_clips(final=True)
+        return chunks
@@ -1,15 +1,20 @@
 #!/usr/bin/env python
 import numpy as np
-from pydub import silence, AudioSegment
-import csv
-import soundfile
-import speech_recognition as sr
 import os
+import speech_detection
+import clip_archive
+import response_clips
+import response_recognition
+import recognition_pool
+import transcription_cache
+import response_matching
+import session_store
+import silence_calibration
+import stage_metrics
 
 """ ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~  TUNABLE PARAMETERS    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ """
 # Trial name (subject name, etc)
 TRIAL_NAME = "nback_test"
-CSV_FILENAME = TRIAL_NAME + ".csv"
 
 # The N value in "N-Back" (usually 2)
 N = 2
@@ -20,169 +25,199 @@ LETTERS = ["A", "B", "C", "D", "E", "H", "I", "K", "L", "M", "O", "P", "R", "S",
 # Name of the matlab file containing stimulus info (include filepath if necessary)
 NUM_TESTS = 20
 
-# The highest audio level (in dB) the program will determine to be considered "silence"
-SILENCE_THRESHOLD_DB = -21.5
+# Sections at least MIN_PERIOD_SILENCE_MS long whose level is at most SILENCE_THRESHOLD_OFFSET_DB above (+) or
+# below (-) the level of the whole recording count as silence (sweep_nback.py tries out different values of both)
 MIN_PERIOD_SILENCE_MS = 500
+SILENCE_THRESHOLD_OFFSET_DB = 0.0
+# Choose the silence threshold for each recording from the levels of its background noise and speech (and the
+# timing of its stimuli) instead. Even when this is off, the threshold is calibrated if the one above finds no
+# responses at all.
+AUTO_CALIBRATE_THRESHOLD = False
+
+# Use the responses detected while recording (run_nback.py's LIVE_DETECTION, saved in the session store)
+# when available instead of detecting them again
+USE_LIVE_ONSETS = False
+
+# Whether to also write each response clip to disk (in <TRIAL_NAME>_reponse_chunks) for human review, and
+# whether to write them all to one archive (<TRIAL_NAME>_clips.wav plus an index, see clip_archive.py) instead
+SAVE_RESPONSE_CLIPS = True
+CLIP_ARCHIVE = False
+
+# Which recognizer classifies each response ("google", "template" for the offline classifier, or "fake"),
+# and any options for it (e.g. {"template_file": "response_templates.npz"})
+RECOGNIZER_BACKEND = "google"
+RECOGNIZER_OPTIONS = {}
+
+# Number of clips recognized at once (1 recognizes them one at a time), whether to use processes instead of
+# threads, the time limit (s) for recognizing a single clip, and how many times to retry transient failures
+RECOGNITION_WORKERS = 8
+RECOGNITION_USE_PROCESSES = False
+RECOGNITION_TIMEOUT_S = 10.0
+RECOGNITION_RETRIES = 2
+
+# File caching recognized responses between runs (None to disable), and the most responses it keeps
+TRANSCRIPTION_CACHE_FILE = "transcription_cache.sqlite"
+TRANSCRIPTION_CACHE_MAX_ENTRIES = 100000
 
 # The minimum period, in milliseconds, that could distinguish two different responses
 STIMULUS_INTERVAL_S = 0.75
 INTERIAL_INTERVAL_S = 2.00
+
+# Save how long each stage of processing took, the most memory it needed and how many items it handled to
+# <TRIAL_NAME>_metrics.json (measuring memory slows processing down a little), and whether to also profile
+# processing with cProfile, saving the stats to <TRIAL_NAME>_profile.prof
+WRITE_METRICS = True
+TRACK_MEMORY = True
+PROFILE = False
 """ ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ """
 
 
-# Normalize audio file to given target dB level - https://stackoverflow.com/questions/59102171/getting-timestamps-from-audio-using-pythons
-def match_target_amplitude(sound, target_dBFS):
-    change_in_dBFS = target_dBFS - sound.dBFS
-    return sound.apply_gain(change_in_dBFS)
+# Raised when no responses can be found in a recording
+class ResponseDetectionError(Exception):
+    pass
+
+
+# Process one trial: detect and recognize the responses in <trial_name>.wav, match them to the stimuli in its
+# session store (see session_store) and save the results there, exporting them as <trial_name>_RESULTS.csv.
+# trial_name may include a directory. Returns a summary row for the trial.
+def process_trial(trial_name):
+    metrics = stage_metrics.StageMetrics(track_memory=TRACK_MEMORY)
+    with stage_metrics.profiled(trial_name + "_profile.prof" if PROFILE else None):
+        summary = run_stages(trial_name, metrics)
+    if WRITE_METRICS:
+        metrics.write_json(trial_name + "_metrics.json")
+    return summary
+
+
+# The stages of process_trial, each timed (and its items counted) in metrics
+def run_stages(trial_name, metrics):
+    with metrics.stage("load"):
+        # Load the letters and stimuli time stamps from the session store
+        session = session_store.load_session(trial_name)
+        letter_sequence = session["letters"]
+        correct_answers = session["answers"]
+        stimuli_time_stamps = session["stimulus_times"]
+
+        print("Interpreting data (this may take a while)...")
+        # Memory-map the recording; detection reads it a block at a time and every clip is sliced straight
+        # from it, so memory use doesn't grow with the length of the recording
+        samples, frame_rate, max_amplitude = speech_detection.wav_samples(trial_name + ".wav")
+        rec_seconds = len(samples) / frame_rate
+
+    with metrics.stage("detect"):
+        # Generate nonsilent chunks (start, end) with a vectorized equivalent of pydub's detect_nonsilent, unless
+        # they were already found while recording
+        calibration = {"silence_threshold_db": np.nan, "noise_floor_db": np.nan, "speech_level_db": np.nan}
+        if USE_LIVE_ONSETS and "live_chunks" in session:
+            response_timing_chunks = session["live_chunks"]
+        elif USE_LIVE_ONSETS and os.path.isfile(trial_name + "_onsets.csv"):
+            response_timing_chunks = response_matching.read_onsets(trial_name + "_onsets.csv")
+        else:
+            response_timing_chunks = np.empty((0, 2), dtype=np.int64)
+            if not AUTO_CALIBRATE_THRESHOLD:
+                # Normalizing the recording to some level and thresholding at that same level is the same as
+                # thresholding the recording as it is at its own level, so only the threshold is computed
+                silence_thresh = speech_detection.recording_level_db(samples, max_amplitude) + \
+                    SILENCE_THRESHOLD_OFFSET_DB
+                response_timing_chunks = speech_detection.detect_nonsilent(
+                    samples, frame_rate, max_amplitude, min_silence_len=MIN_PERIOD_SILENCE_MS,
+                    silence_thresh=silence_thresh, seek_step=1)
+                # A chunk starting at the very beginning is the recording itself (or noise as it started), not a
+                # response, so a recording with no silent window at all counts as having no responses
+                response_timing_chunks = response_timing_chunks[response_timing_chunks[:, 0] != 0]
+            if len(response_timing_chunks) == 0:
+                # Pick a threshold that suits this recording's noise floor
+                try:
+                    threshold_db, noise_floor_db, speech_level_db = silence_calibration.calibrate_threshold(
+                        samples, frame_rate, max_amplitude, MIN_PERIOD_SILENCE_MS, stimuli_time_stamps[:NUM_TESTS],
+                        N, STIMULUS_INTERVAL_S + INTERIAL_INTERVAL_S)
+                except silence_calibration.CalibrationError as err:
+                    raise ResponseDetectionError(f"Could not detect user's responses. {err}")
+                print(f"Calibrated silence threshold: {threshold_db:.1f} dB (noise floor {noise_floor_db:.0f} dB, "
+                      f"speech {speech_level_db:.0f} dB)")
+                calibration = {"silence_threshold_db": threshold_db, "noise_floor_db": noise_floor_db,
+                               "speech_level_db": speech_level_db}
+                response_timing_chunks = speech_detection.detect_nonsilent(samples, frame_rate, max_amplitude,
+                                                                           MIN_PERIOD_SILENCE_MS, threshold_db)
+
+        # If unable to detect nonsilence (other than at the very beginning), end program and notify user
+        response_timing_chunks = np.asarray(response_timing_chunks).reshape(-1, 2)
+        response_timing_chunks = response_timing_chunks[response_timing_chunks[:, 0] != 0]
+        if len(response_timing_chunks) == 0:
+            raise ResponseDetectionError("Could not detect user's responses. "
+                                         "Silence threshold/Minimum silence period may need tuning.")
+
+        # Calculate the time that the user starts to speak in each nonsilent "chunk"
+        response_timing_markers = np.array(response_timing_chunks[:, 0]) / 1000.0
+        metrics.count("chunks_detected", len(response_timing_chunks))
+
+    with metrics.stage("clip"):
+        clip_bounds = response_clips.clip_bounds(response_timing_chunks, rec_seconds * 1000.0)
+
+        # Optionally store the individual responses as clips in a folder to help a human review response
+        # accuracies
+        clip_seperation_path = trial_name + "_reponse_chunks"
+        if SAVE_RESPONSE_CLIPS and CLIP_ARCHIVE:
+            clip_archive.write_clip_archive(trial_name, samples, frame_rate, max_amplitude, clip_bounds)
+            metrics.count("clips_written", len(clip_bounds))
+        elif SAVE_RESPONSE_CLIPS:
+            if not os.path.isdir(clip_seperation_path):
+                os.mkdir(clip_seperation_path)
+            for i in range(len(clip_bounds)):
+                clip = response_clips.clip_pcm16(samples, frame_rate, max_amplitude, *clip_bounds[i])
+                response_clips.write_clip(os.path.join(clip_seperation_path, f"chunk{i}.wav"), clip, frame_rate)
+            metrics.count("clips_written", len(clip_bounds))
+
+    with metrics.stage("match"):
+        # Calculate the reponse times given the arrays for response_timing_markers and stimuli_time_stamps,
+        # and which clip holds the response to each stimulus (-9999 if there isn't one)
+        clip_index_array, reaction_times = response_matching.match_responses(
+            stimuli_time_stamps[:NUM_TESTS], response_timing_markers, N, STIMULUS_INTERVAL_S + INTERIAL_INTERVAL_S)
+        metrics.count("stimuli_matched", np.count_nonzero(clip_index_array >= 0))
+
+    with metrics.stage("recognize"):
+        # Determine whether each matched response was correct using speech recognition, recognizing all of the
+        # matched clips concurrently
+        recognizer = response_recognition.make_recognizer(RECOGNIZER_BACKEND, **RECOGNIZER_OPTIONS)
+        cache = None
+        if TRANSCRIPTION_CACHE_FILE is not None:
+            cache = transcription_cache.TranscriptionCache(TRANSCRIPTION_CACHE_FILE, TRANSCRIPTION_CACHE_MAX_ENTRIES)
+        matched_clips = {j: response_clips.clip_pcm16(samples, frame_rate, max_amplitude, *clip_bounds[j])
+                         for j in np.unique(clip_index_array[clip_index_array >= 0])}
+        clip_responses = recognition_pool.recognize_clips(recognizer, matched_clips, frame_rate,
+                                                          max_workers=RECOGNITION_WORKERS,
+                                                          timeout=RECOGNITION_TIMEOUT_S, retries=RECOGNITION_RETRIES,
+                                                          use_processes=RECOGNITION_USE_PROCESSES, cache=cache,
+                                                          metrics=metrics)
+        if cache is not None:
+            print(cache.summary())
+            cache.close()
+
+    with metrics.stage("write"):
+        # Determine the raw user responses and response accuracy (TRUE, FALSE, or N/A), and label each reaction
+        # time according to if it was within the alloted time or not
+        raw_responses, response_accuracies = response_matching.score_responses(letter_sequence[:NUM_TESTS], N,
+                                                                               clip_index_array, clip_responses)
+        reaction_on_time = response_matching.reactions_on_time(raw_responses, reaction_times,
+                                                               STIMULUS_INTERVAL_S + INTERIAL_INTERVAL_S)
+
+        # Save the results to the session store, and export them as a csv for review
+        session = session_store.save_session(
+            trial_name, n=N, chunks=response_timing_chunks, response_onsets=response_timing_markers,
+            clip_index=clip_index_array, reaction_times=reaction_times,
+            responses=np.where(raw_responses == "N/A", "", raw_responses),
+            correct=session_store.accuracies_to_correct(response_accuracies), on_time=reaction_on_time,
+            clip_files=SAVE_RESPONSE_CLIPS and not CLIP_ARCHIVE, clip_archive=SAVE_RESPONSE_CLIPS and CLIP_ARCHIVE,
+            **calibration)
+        session_store.export_results_csv(trial_name, session)
+    return response_matching.summarize_trial(trial_name, N, response_accuracies, reaction_times, reaction_on_time,
+                                             len(response_timing_markers))
 
 
 if __name__ == "__main__":
-    # Open CSV file, read in letters array and stimuli time stamps
-    file = open(CSV_FILENAME)
-    reader = csv.reader(file)
-    header = next(reader)
-    data = []
-    for row in reader:
-        if len(row) > 0:
-            data.append(row)
-    data = np.array(data)
-    letter_sequence = np.array(data[:, 0], dtype=str)
-    correct_answers = np.array(data[:, 1], dtype=str)
-    stimuli_time_stamps = np.array(data[:, 2], dtype=float)
-
-    print("Interpreting data (this may take a while)...")
-    # Open .wav with pydub
-    audio_segment = AudioSegment.from_wav(TRIAL_NAME + ".wav")
-    rec_seconds = audio_segment.duration_seconds
-
-    # Normalize audio_segment to a threshold
-    normalized_sound = match_target_amplitude(audio_segment, SILENCE_THRESHOLD_DB)
-
-    # Generate nonsilent chunks (start, end) with pydub
-    response_timing_chunks = np.array(
-        silence.detect_nonsilent(normalized_sound, min_silence_len=MIN_PERIOD_SILENCE_MS, silence_thresh=SILENCE_THRESHOLD_DB,
-                         seek_step=1))
-
-    # If unable to detect nonsilence, end program and notify user
-    if len(response_timing_chunks) == 0:
-        print("Could not detect user's responses. Silence threshold/Minimum silence period may need tuning.")
+    try:
+        process_trial(TRIAL_NAME)
+    except ResponseDetectionError as err:
+        print(err)
         exit(1)
-
-    # Calculate the time that the user starts to speak in each nonsilent "chunk"
-    response_timing_markers = np.array(response_timing_chunks[:, 0]) / 1000.0
-    while response_timing_markers[0] == 0.0:
-        response_timing_markers = np.delete(response_timing_markers, 0)
-        response_timing_chunks = np.delete(response_timing_chunks, 0, 0)
-
-    # Create a folder to store the individual responses as clips to help determine
-    # response accuracies later on.
-    clip_seperation_path = TRIAL_NAME + "_reponse_chunks"
-    if not os.path.isdir(clip_seperation_path):
-        os.mkdir(clip_seperation_path)
-    # How much we add (ms) to the ends of a clip when saved
-    clip_threshold = 600
-    for i in range(len(response_timing_chunks)):
-        chunk = response_timing_chunks[i]
-        chunk_filename = os.path.join(clip_seperation_path, f"chunk{i}.wav")
-        # Save the chunk as a serperate wav, acounting for the fact it could be at the very beggining or end
-        if chunk[0] <= clip_threshold:
-            (audio_segment[0:chunk[1] + clip_threshold]).export(chunk_filename, format="wav")
-        elif chunk[1] >= ((rec_seconds * 1000.0) - clip_threshold - 1):
-            (audio_segment[chunk[0] - clip_threshold:(rec_seconds * 1000) - 1]).export(chunk_filename, format="wav")
-        else:
-            (audio_segment[chunk[0] - clip_threshold:chunk[1] + clip_threshold]).export(chunk_filename,
-                                                                                        format="wav")
-        # Reformat the wav files using soundfile to allow for speech recongition, and store in folder
-        data, samplerate = soundfile.read(chunk_filename)
-        soundfile.write(chunk_filename, data, samplerate, subtype='PCM_16')
-
-    # Create an array to hold users response accuracy (TRUE, FALSE, or N/A)
-    response_accuracies = []
-
-    # Init the speech to text recognizer
-    r = sr.Recognizer()
-
-    # Create an array to hold raw user responses
-    raw_responses = []
-
-    # Calculate the reponse times given the arrays for response_timing_markers and stimuli_time_stamps
-    reaction_times = []
-    clip_index_array = np.empty(NUM_TESTS, dtype=int)
-    for i in range(NUM_TESTS):
-        rt = float('nan')
-        clip_index_array[i] = -9999
-        # Only look for an answer after N number of stimuli have been displayed
-        if i < N or (stimuli_time_stamps[i] > response_timing_markers[-1]):
-            response_accuracies.append("N/A")
-            raw_responses.append("N/A")
-        else:
-            # Determine the most accurate nonsilent chunk that is associated with a given iteration
-            for j in range(len(response_timing_markers)):
-                if response_timing_markers[j] > stimuli_time_stamps[i]:
-                    # If reaction is too fast, it means the program is considering a delayed response from previous stimulus
-                    # Thus, we should continue the loop if that is the case, otherwise, break and store the reaction time
-                    if response_timing_markers[j] - stimuli_time_stamps[i] < 0.1 and len(reaction_times) > 0 and \
-                            reaction_times[-1] > (STIMULUS_INTERVAL_S + INTERIAL_INTERVAL_S):
-                        continue
-                    rt = response_timing_markers[j] - stimuli_time_stamps[i]
-                    break
-            # If there is no nonsilent chunk after the time that the stimulus is displayed, store reaction time as "nan"
-            # Also if the user's response is over 1.6s after the stimulus is displayed, then we know they either failed to
-            # respond or the audio was not recorded and intepreted properly.
-            if j >= len(response_timing_markers) or (rt > (STIMULUS_INTERVAL_S + INTERIAL_INTERVAL_S) * 1.2):
-                reaction_times.append(float('nan'))
-                raw_responses.append("N/A")
-                response_accuracies.append("N/A")
-                continue
-            else:
-                # Save index to clip index array
-                clip_index_array[i] = j
-                # If the response was valid, detemine if it was correct using speech recognition
-                with sr.AudioFile(os.path.join(clip_seperation_path, f"chunk{j}.wav")) as source:
-                    # listen for the data (load audio to memory)
-                    audio_data = r.record(source)
-                    # recognize (convert from speech to text)
-                    try:
-                        resp = (r.recognize_google(audio_data).split()[0]).upper()
-                    # If no response can be determined, report accuracies as N/A, store reaction time, and move on
-                    except sr.UnknownValueError as err:
-                        response_accuracies.append("N/A")
-                        raw_responses.append("N/A")
-                        reaction_times.append(rt)
-                        continue
-                    # compare response from stt to the actual response, update response_accuracies accordingly
-                    if (resp[0] == "Y" and (letter_sequence[i] == letter_sequence[i-N])) or (
-                            resp[0] == "N" and (letter_sequence[i] != letter_sequence[i-N])):
-                        response_accuracies.append("TRUE")
-                    else:
-                        response_accuracies.append("FALSE")
-                    raw_responses.append(resp)
-        reaction_times.append(rt)
-
-    # Create another array to label each reactiontime according to if it was within the alloted time or not
-    reaction_on_time = np.empty(NUM_TESTS, dtype=bool)
-    for i in range(NUM_TESTS):
-        if len(raw_responses[i]) > 0 and raw_responses[i] != "N/A" and reaction_times[i] > (STIMULUS_INTERVAL_S + INTERIAL_INTERVAL_S):
-            reaction_on_time[i] = False
-        else:
-            reaction_on_time[i] = True
-
-    # Write results to file
-    with open(TRIAL_NAME + "_RESULTS.csv", 'w') as reac_file:
-        writer = csv.writer(reac_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        writer.writerow(
-            ['LETTER', 'Correct Answer', 'User response', 'Accuracy (T/F)', 'Reaction time (s)',
-             'Reaction on time (T/F)', 'Clip Index', ' ', ' ', 'Times that user speaks (from start)'])
-        num_rows_in_table = max([len(response_timing_markers), len(correct_answers)])
-        for i in range(num_rows_in_table):
-            if i >= len(response_timing_markers):
-                writer.writerow([letter_sequence[i], correct_answers[i], raw_responses[i], response_accuracies[i],
-                                 reaction_times[i], reaction_on_time[i], clip_index_array[i], ' ', ' ', -1.0])
-            # Make sure all fields are filled out (-1 if invalid) in cases where there are more responses than stimuli or vice versa
-            elif i >= len(correct_answers):
-                writer.writerow([-1, -1, -1, -1, -1, -1, -1, ' ', ' ', response_timing_markers[i]])
-            else:
-                writer.writerow([letter_sequence[i], correct_answers[i], raw_responses[i], response_accuracies[i],
-                                 reaction_times[i], reaction_on_time[i], clip_index_array[i], ' ', ' ',
-                                 response_timing_markers[i]])
     print("Done")
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+
+# Errors worth retrying (network hiccups, rate limiting, timeouts)
+TRANSIENT_ERRORS = (OSError, TimeoutError)
+
+
+# TRANSIENT_ERRORS plus speech_recognition's request errors. Only recognizers that use speech_recognition can
+# raise those, so it is never imported just to check for them.
+def transient_errors():
+    sr = sys.modules.get("speech_recognition")
+    return TRANSIENT_ERRORS if sr is None else TRANSIENT_ERRORS + (sr.RequestError,)
+
+
+# Recognize one clip, retrying transient failures with exponential backoff. Returns (response, error message,
+# number of calls made to the recognizer)
+def recognize_with_retry(recognizer, pcm16, frame_rate, retries=2, backoff_s=0.5):
+    for attempt in range(retries + 1):
+        try:
+            return recognizer.recognize(pcm16, frame_rate), None, attempt + 1
+        except Exception as err:
+            if not isinstance(err, transient_errors()):
+                raise
+            if attempt == retries:
+                return None, f"{type(err).__name__}: {err}", attempt + 1
+            time.sleep(backoff_s * 2 ** attempt)
+
+
+# The longest recognize_with_retry can take on one clip if every attempt runs into the recognizer's timeout
+def clip_time_limit(timeout, retries=2, backoff_s=0.5):
+    return (retries + 1) * timeout + backoff_s * (2 ** retries - 1)
+
+
+# Recognize many clips at once. clips maps a clip index to its 16-bit samples; the result maps each clip
+# index to the recognized response (None if it couldn't be determined). At most max_workers clips are in
+# flight at a time; max_workers=1 recognizes the clips one after another without a pool. timeout (s) is
+# handed to the recognizer as its per-clip limit, and a pooled clip still unrecognized once every attempt
+# could have used it up is given up on. A clip that times out, or makes the recognizer raise anything but a
+# transient error, is reported as a failure (response None) instead of stopping the others. If a
+# TranscriptionCache is given, only clips missing from it are sent to the recognizer, and their responses are
+# added to it. If a stage_metrics.StageMetrics is given, the recognizer calls, failures and cache hits are
+# counted in it.
+def recognize_clips(recognizer, clips, frame_rate, max_workers=4, timeout=None, retries=2, backoff_s=0.5,
+                    use_processes=False, cache=None, metrics=None):
+    if timeout is not None:
+        recognizer.timeout = timeout
+    responses = {}
+    failures = {}
+    if cache is not None:
+        cache_keys = {clip_index: cache.key(recognizer, pcm16, frame_rate) for clip_index, pcm16 in clips.items()}
+        uncached_clips = {}
+        for clip_index, pcm16 in clips.items():
+            found, response = cache.get(cache_keys[clip_index])
+            if found:
+                responses[clip_index] = response
+            else:
+                uncached_clips[clip_index] = pcm16
+        if metrics is not None:
+            metrics.count("cache_hits", len(clips) - len(uncached_clips))
+            metrics.count("cache_misses", len(uncached_clips))
+        clips = uncached_clips
+    calls = 0
+    if max_workers <= 1 or len(clips) <= 1:
+        for clip_index, pcm16 in clips.items():
+            try:
+                responses[clip_index], error, attempts = recognize_with_retry(recognizer, pcm16, frame_rate,
+                                                                              retries, backoff_s)
+            except Exception as err:
+                responses[clip_index], error, attempts = None, f"{type(err).__name__}: {err}", 1
+            calls += attempts
+            if error is not None:
+                failures[clip_index] = error
+    else:
+        executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        time_limit = None if timeout is None else clip_time_limit(timeout, retries, backoff_s)
+        executor = executor_class(max_workers=max_workers)
+        try:
+            futures = {clip_index: executor.submit(recognize_with_retry, recognizer, pcm16, frame_rate, retries,
+                                                   backoff_s)
+                       for clip_index, pcm16 in clips.items()}
+            for clip_index, future in futures.items():
+                try:
+                    responses[clip_index], error, attempts = future.result(timeout=time_limit)
+                except FutureTimeoutError:
+                    future.cancel()
+                    responses[clip_index], error, attempts = None, f"timed out after {time_limit:g} s", 1
+                except Exception as err:
+                    responses[clip_index], error, attempts = None, f"{type(err).__name__}: {err}", 1
+                calls += attempts
+                if error is not None:
+                    failures[clip_index] = error
+        finally:
+            # Don't wait for clips that were given up on; their workers finish (or hang) in the background
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    # Remember everything that was recognized without errors
+    if cache is not None:
+        for clip_index in clips:
+            if clip_index not in failures:
+                cache.put(cache_keys[clip_index], responses[clip_index])
+
+    if metrics is not None:
+        metrics.count("clips_recognized", len(clips))
+        metrics.count("recognizer_calls", calls)
+        metrics.count("recognition_failures", len(failures))
+
+    # Let the user know which clips need to be reviewed by hand
+    for clip_index, error in failures.items():
+        print(f"Could not recognize clip {clip_index} ({error})")
+    return responses
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+import numpy as np
+import soundfile
+import speech_detection
+
+# How much we add (ms) to the ends of a clip
+CLIP_PADDING_MS = 600
+
+
+# Work out the (start, end) in ms of the clip saved for each nonsilent chunk, padding both ends and
+# accounting for the fact a chunk could be at the very beginning or end of the recording
+def clip_bounds(response_timing_chunks, rec_ms, padding_ms=CLIP_PADDING_MS):
+    chunks = np.asarray(response_timing_chunks, dtype=np.float64).reshape(-1, 2)
+    starts = chunks[:, 0] - padding_ms
+    ends = chunks[:, 1] + padding_ms
+    at_start = chunks[:, 0] <= padding_ms
+    at_end = ~at_start & (chunks[:, 1] >= rec_ms - padding_ms - 1)
+    starts[at_start] = 0
+    ends[at_end] = rec_ms - 1
+    return np.column_stack((starts, ends))
+
+
+# Slice a clip out of the decoded recording and convert it to mono 16-bit PCM in memory
+def clip_pcm16(samples, frame_rate, max_amplitude, start_ms, end_ms):
+    samples = np.asarray(samples)
+    if samples.ndim == 1:
+        samples = samples[:, np.newaxis]
+    start, end = speech_detection.ms_to_frame([start_ms, end_ms], frame_rate)
+    clip = samples[max(start, 0):max(end, 0)]
+    if samples.dtype == np.int16 and samples.shape[1] == 1:
+        return clip[:, 0].copy()
+    mono = clip.astype(np.float64).mean(axis=1) / max_amplitude
+    return np.clip(np.round(mono * 32767), -32768, 32767).astype(np.int16)
+
+
+# Wrap 16-bit PCM samples as speech_recognition AudioData so they can go straight to a recognizer
+def to_audio_data(pcm16, frame_rate):
+    import speech_recognition as sr
+    return sr.AudioData(np.ascontiguousarray(pcm16, dtype=np.int16).tobytes(), frame_rate, 2)
+
+
+# Save a clip as a 16-bit wav for review by a human
+def write_clip(filename, pcm16, frame_rate):
+    soundfile.write(filename, pcm16, frame_rate, subtype='PCM_16')
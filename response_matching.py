@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+import csv
+import numpy as np
+
+# A response sooner than this (s) after a stimulus is treated as a delayed response to the previous one
+# (when the previous response was late)
+MIN_REACTION_S = 0.1
+# Responses later than this multiple of the response window are not counted as responses to the stimulus
+TIMEOUT_FACTOR = 1.2
+# Clip index stored for stimuli without a matched response
+NO_CLIP = -9999
+
+
+# Match every stimulus to the nonsilent chunk holding its response. Returns an array of clip indices
+# (NO_CLIP if unmatched) and an array of reaction times (nan if unmatched). response_window_s is the time
+# between the onsets of consecutive stimuli; clip_mask optionally excludes clips from matching.
+#
+# Each stimulus takes the first response after it, unless the previous stimulus's reaction was late, in
+# which case responses within MIN_REACTION_S belong to that previous stimulus and are skipped. Because that
+# rule only depends on whether the previous reaction was late, the whole chain reduces to a boolean
+# recurrence that is solved with cumulative sums instead of a loop.
+def match_responses(stimuli_time_stamps, response_timing_markers, n, response_window_s, clip_mask=None):
+    stimuli_time_stamps = np.asarray(stimuli_time_stamps, dtype=np.float64)
+    response_timing_markers = np.asarray(response_timing_markers, dtype=np.float64)
+    num_stimuli = len(stimuli_time_stamps)
+    clip_index = np.full(num_stimuli, NO_CLIP, dtype=int)
+    reaction_times = np.full(num_stimuli, np.nan)
+
+    allowed_clips = np.arange(len(response_timing_markers))
+    if clip_mask is not None:
+        allowed_clips = allowed_clips[np.asarray(clip_mask, dtype=bool)]
+    markers = response_timing_markers[allowed_clips]
+    num_markers = len(markers)
+    if num_stimuli == 0 or num_markers == 0:
+        return clip_index, reaction_times
+
+    # Only look for an answer after N number of stimuli have been displayed
+    eligible = (np.arange(num_stimuli) >= n) & ~(stimuli_time_stamps > markers[-1])
+
+    # Candidate 0: the first response after the stimulus. Candidate 1: the first one at least MIN_REACTION_S
+    # after it (the exact float comparison is rechecked on either side of the searchsorted estimate)
+    def reaction_to(j):
+        return markers[np.minimum(j, num_markers - 1)] - stimuli_time_stamps
+
+    first = np.searchsorted(markers, stimuli_time_stamps, side="right")
+    first_slow = np.maximum(np.searchsorted(markers, stimuli_time_stamps + MIN_REACTION_S, side="left"), first)
+    first_slow = np.where((first_slow < num_markers) & (reaction_to(first_slow) < MIN_REACTION_S),
+                          first_slow + 1, first_slow)
+    first_slow = np.where((first_slow > first) & (reaction_to(first_slow - 1) >= MIN_REACTION_S),
+                          first_slow - 1, first_slow)
+
+    # Reaction times for each candidate; responses that come too long after the stimulus don't count
+    timeout = response_window_s * TIMEOUT_FACTOR
+    rt_first = np.where(eligible & (first < num_markers), reaction_to(first), np.nan)
+    rt_slow = np.where(eligible & (first_slow < num_markers), reaction_to(first_slow), np.nan)
+    rt_first[rt_first > timeout] = np.nan
+    rt_slow[rt_slow > timeout] = np.nan
+    late_first = rt_first > response_window_s
+    late_slow = rt_slow > response_window_s
+
+    # late[i] = late_slow[i] if late[i-1] else late_first[i]. Where both candidates agree late[i] is fixed;
+    # otherwise it either copies or negates late[i-1]. So late[i] is the last fixed value, flipped once for
+    # every negation since.
+    fixed = late_first == late_slow
+    fixed[0] = True
+    negates = late_first & ~late_slow
+    last_fixed = np.maximum.accumulate(np.where(fixed, np.arange(num_stimuli), 0))
+    negations = np.cumsum(negates)
+    late = late_first[last_fixed] ^ ((negations - negations[last_fixed]) % 2 == 1)
+    skip_fast = np.concatenate(([False], late[:-1]))
+
+    chosen = np.where(skip_fast, first_slow, first)
+    reaction_times = np.where(skip_fast, rt_slow, rt_first)
+    matched = ~np.isnan(reaction_times)
+    clip_index[matched] = allowed_clips[chosen[matched]]
+    return clip_index, reaction_times
+
+
+# Turn the recognized response to each stimulus into the raw response and accuracy columns. clip_responses
+# maps a clip index to its recognized response (None if unknown).
+def score_responses(letter_sequence, n, clip_index, clip_responses):
+    letter_sequence = np.asarray(letter_sequence)
+    responses = [clip_responses.get(j) for j in clip_index]
+    has_response = np.array([resp is not None for resp in responses], dtype=bool)
+    raw_responses = np.array([resp if resp is not None else "N/A" for resp in responses], dtype=object)
+    first_letter = np.array([resp[0] if resp else "" for resp in responses], dtype=object)
+
+    # Whether each letter is the same as the one N iterations ago
+    is_target = np.zeros(len(letter_sequence), dtype=bool)
+    is_target[n:] = letter_sequence[n:] == letter_sequence[:len(letter_sequence) - n]
+    correct = ((first_letter == "Y") & is_target) | ((first_letter == "N") & ~is_target)
+    accuracies = np.where(has_response, np.where(correct, "TRUE", "FALSE"), "N/A")
+    return raw_responses, accuracies
+
+
+# Label each reaction time according to whether it was within the alloted time or not
+def reactions_on_time(raw_responses, reaction_times, response_window_s):
+    raw_responses = np.asarray(raw_responses, dtype=str)
+    responded = (np.char.str_len(raw_responses) > 0) & (raw_responses != "N/A")
+    return ~(responded & (np.asarray(reaction_times, dtype=np.float64) > response_window_s))
+
+
+# Write the results table, padding with -1 where there are more responses than stimuli or vice versa
+def write_results(filename, letter_sequence, correct_answers, raw_responses, accuracies, reaction_times,
+                  reaction_on_time, clip_index, response_timing_markers):
+    num_stimuli = len(correct_answers)
+    num_markers = len(response_timing_markers)
+    stimulus_rows = zip(letter_sequence, correct_answers, raw_responses, accuracies, reaction_times,
+                        reaction_on_time, clip_index)
+    with open(filename, 'w') as reac_file:
+        writer = csv.writer(reac_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(
+            ['LETTER', 'Correct Answer', 'User response', 'Accuracy (T/F)', 'Reaction time (s)',
+             'Reaction on time (T/F)', 'Clip Index', ' ', ' ', 'Times that user speaks (from start)'])
+        for i, row in enumerate(stimulus_rows):
+            writer.writerow(list(row) + [' ', ' ', response_timing_markers[i] if i < num_markers else -1.0])
+        writer.writerows([-1, -1, -1, -1, -1, -1, -1, ' ', ' ', response_timing_markers[i]]
+                         for i in range(num_stimuli, num_markers))
+
+
+# Columns of the per-trial summary row returned by summarize_trial
+SUMMARY_HEADER = ['Trial', 'N', 'Stimuli', 'Responses detected', 'Responses matched', 'Responses recognized',
+                  'Correct', 'Accuracy (%)', 'Median reaction time (s)', 'On time (%)']
+
+
+# Summarize a trial's results as one row of a combined summary table
+def summarize_trial(trial_name, n, accuracies, reaction_times, reaction_on_time, num_responses):
+    accuracies = np.asarray(accuracies, dtype=str)
+    reaction_times = np.asarray(reaction_times, dtype=np.float64)
+    matched = ~np.isnan(reaction_times)
+    recognized = accuracies != "N/A"
+    num_correct = int(np.count_nonzero(accuracies == "TRUE"))
+    accuracy = 100.0 * num_correct / np.count_nonzero(recognized) if np.any(recognized) else float('nan')
+    median_rt = float(np.median(reaction_times[matched])) if np.any(matched) else float('nan')
+    on_time = 100.0 * np.count_nonzero(np.asarray(reaction_on_time)[matched]) / np.count_nonzero(matched) \
+        if np.any(matched) else float('nan')
+    return [trial_name, n, len(accuracies), num_responses, int(np.count_nonzero(matched)),
+            int(np.count_nonzero(recognized)), num_correct, accuracy, median_rt, on_time]
+
+
+# Save the responses found while recording (see live_detection), and the reaction times they give
+def write_onsets(filename, chunks, stimuli_time_stamps, n, response_window_s):
+    markers = chunks[:, 0] / 1000.0
+    clip_index, reaction_times = match_responses(stimuli_time_stamps, markers, n, response_window_s)
+    with open(filename, 'w') as onsets_file:
+        writer = csv.writer(onsets_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(['Response start (ms)', 'Response end (ms)', 'Stimulus', 'Reaction time (s)'])
+        for j in range(len(chunks)):
+            stimuli = np.flatnonzero(clip_index == j)
+            stimulus = stimuli[0] if len(stimuli) else -1
+            writer.writerow([chunks[j, 0], chunks[j, 1], stimulus,
+                             reaction_times[stimulus] if stimulus >= 0 else float('nan')])
+
+
+# Read the (start_ms, end_ms) of the responses saved by write_onsets
+def read_onsets(filename):
+    with open(filename) as onsets_file:
+        reader = csv.reader(onsets_file)
+        header = next(reader)
+        chunks = [[int(row[0]), int(row[1])] for row in reader if len(row) > 0]
+    return np.array(chunks, dtype=np.int64).reshape(-1, 2)
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+import hashlib
+import numpy as np
+import response_clips
+
+""" ~~~~~~~~~~~~~     TUNABLE PARAMETERS (enrollment)     ~~~~~~~~~~~~~ """
+# Trial whose reviewed results/clips are used to enroll templates for the local recognizer
+TRIAL_NAME = "nback_test"
+RESULTS_CSV_FILENAME = TRIAL_NAME + "_RESULTS.csv"
+CLIP_SEPERATION_PATH = TRIAL_NAME + "_reponse_chunks"
+
+# File the enrolled templates are saved to
+TEMPLATE_FILE = "response_templates.npz"
+"""~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~"""
+
+# Analysis frames used for the spectral features (seconds)
+FRAME_S = 0.025
+HOP_S = 0.010
+# Frames quieter than this (dB relative to the loudest frame) are ignored as silence
+ACTIVITY_FLOOR_DB = -35.0
+# Log-spaced frequency bands summarizing each frame's spectrum
+NUM_BANDS = 16
+MIN_BAND_HZ = 100.0
+MAX_BAND_HZ = 8000.0
+# Number of equal time segments the spoken part of a clip is split into
+NUM_SEGMENTS = 3
+# Frequency above which energy is treated as the "s" at the end of "yes"
+SIBILANCE_HZ = 3500.0
+
+
+# Base class for anything that can turn a response clip into a word. recognize() returns the first word
+# heard (upper case), or None if no response can be determined. timeout (s) limits a single clip for
+# backends that make network calls.
+class ResponseRecognizer:
+    name = "base"
+    version = "1"
+    timeout = None
+
+    def recognize(self, pcm16, frame_rate):
+        raise NotImplementedError
+
+    # Identifies this backend (and anything that changes what it hears) in the transcription cache
+    def cache_id(self):
+        return f"{self.name}-{self.version}"
+
+
+# Google's web speech API through speech_recognition (needs network access, one request per clip)
+class GoogleRecognizer(ResponseRecognizer):
+    name = "google"
+    version = "1"
+
+    def __init__(self, language="en-US"):
+        import speech_recognition as sr
+        self.language = language
+        self.recognizer = sr.Recognizer()
+
+    def cache_id(self):
+        return f"{self.name}-{self.version}-{self.language}"
+
+    def recognize(self, pcm16, frame_rate):
+        import speech_recognition as sr
+        audio_data = response_clips.to_audio_data(pcm16, frame_rate)
+        self.recognizer.operation_timeout = self.timeout
+        try:
+            words = self.recognizer.recognize_google(audio_data, language=self.language).split()
+        except sr.UnknownValueError:
+            return None
+        if len(words) == 0:
+            return None
+        return words[0].upper()
+
+
+# Summarize the spoken part of a clip as log band energies over a few time segments. Returns None if
+# the clip is silent.
+def clip_features(pcm16, frame_rate):
+    x = np.asarray(pcm16, dtype=np.float64) / 32768.0
+    frame_len = int(FRAME_S * frame_rate)
+    hop = int(HOP_S * frame_rate)
+    if len(x) < frame_len or not np.any(x):
+        return None
+
+    # Split the clip into overlapping windowed frames and keep only the ones with speech in them
+    frames = np.lib.stride_tricks.sliding_window_view(x, frame_len)[::hop]
+    energy = np.square(frames).sum(axis=1)
+    active = energy >= energy.max() * 10 ** (ACTIVITY_FLOOR_DB / 10.0)
+    first, last = np.flatnonzero(active)[[0, -1]]
+    frames = frames[first:last + 1]
+    if len(frames) < NUM_SEGMENTS:
+        return None
+
+    power = np.square(np.abs(np.fft.rfft(frames * np.hanning(frame_len), axis=1)))
+    freqs = np.fft.rfftfreq(frame_len, 1.0 / frame_rate)
+    edges = np.geomspace(MIN_BAND_HZ, min(MAX_BAND_HZ, frame_rate / 2.0), NUM_BANDS + 1)
+    band_of_bin = np.searchsorted(edges, freqs, side="right") - 1
+    in_band = (band_of_bin >= 0) & (band_of_bin < NUM_BANDS)
+
+    # Sum the power in each band for every frame, then average the frames within each time segment
+    bands = power[:, in_band] @ (band_of_bin[in_band, np.newaxis] == np.arange(NUM_BANDS))
+    segments = np.array([seg.mean(axis=0) for seg in np.array_split(bands, NUM_SEGMENTS)])
+    log_bands = np.log10(segments + 1e-10)
+    # Remove the overall level of each segment so loudness doesn't affect the match
+    log_bands -= log_bands.mean(axis=1, keepdims=True)
+    return log_bands.ravel()
+
+
+# Fraction of the energy in the last part of the spoken clip that lies above SIBILANCE_HZ
+def sibilance_ratio(pcm16, frame_rate):
+    x = np.asarray(pcm16, dtype=np.float64)
+    frame_len = int(FRAME_S * frame_rate)
+    hop = int(HOP_S * frame_rate)
+    if len(x) < frame_len or not np.any(x):
+        return None
+    frames = np.lib.stride_tricks.sliding_window_view(x, frame_len)[::hop]
+    energy = np.square(frames).sum(axis=1)
+    active = np.flatnonzero(energy >= energy.max() * 10 ** (ACTIVITY_FLOOR_DB / 10.0))
+    tail = frames[active[0] + (active[-1] - active[0]) * 2 // 3:active[-1] + 1]
+    power = np.square(np.abs(np.fft.rfft(tail * np.hanning(frame_len), axis=1))).sum(axis=0)
+    freqs = np.fft.rfftfreq(frame_len, 1.0 / frame_rate)
+    return power[freqs >= SIBILANCE_HZ].sum() / power.sum()
+
+
+# Fully local yes/no classifier. With enrolled templates it labels a clip with its nearest template
+# centroid; without any, it falls back to looking for the "s" at the end of "yes".
+class TemplateRecognizer(ResponseRecognizer):
+    name = "template"
+    version = "1"
+
+    def __init__(self, template_file=None, max_distance=None, sibilance_threshold=0.2):
+        self.labels = np.empty(0, dtype=str)
+        self.centroids = np.empty((0, NUM_BANDS * NUM_SEGMENTS))
+        self.max_distance = max_distance
+        self.sibilance_threshold = sibilance_threshold
+        if template_file is not None:
+            self.load(template_file)
+
+    # Build one centroid per label (e.g. "YES", "NO") from labeled clips
+    def enroll(self, clips, labels, frame_rate):
+        features = []
+        kept_labels = []
+        for clip, label in zip(clips, labels):
+            f = clip_features(clip, frame_rate)
+            if f is not None:
+                features.append(f)
+                kept_labels.append(label.upper())
+        if len(features) == 0:
+            raise ValueError("None of the enrollment clips contained speech")
+        features = np.array(features)
+        kept_labels = np.array(kept_labels)
+        self.labels = np.unique(kept_labels)
+        self.centroids = np.array([features[kept_labels == label].mean(axis=0) for label in self.labels])
+
+    def save(self, template_file):
+        np.savez(template_file, labels=self.labels, centroids=self.centroids)
+
+    def load(self, template_file):
+        with np.load(template_file) as templates:
+            self.labels = templates["labels"]
+            self.centroids = templates["centroids"]
+
+    def cache_id(self):
+        digest = hashlib.sha1(repr((self.labels.tolist(), self.centroids.tolist(), self.max_distance,
+                                    self.sibilance_threshold)).encode()).hexdigest()
+        return f"{self.name}-{self.version}-{digest[:12]}"
+
+    def recognize(self, pcm16, frame_rate):
+        if len(self.labels) == 0:
+            ratio = sibilance_ratio(pcm16, frame_rate)
+            if ratio is None:
+                return None
+            return "YES" if ratio >= self.sibilance_threshold else "NO"
+        features = clip_features(pcm16, frame_rate)
+        if features is None:
+            return None
+        distances = np.linalg.norm(self.centroids - features, axis=1)
+        best = np.argmin(distances)
+        if self.max_distance is not None and distances[best] > self.max_distance:
+            return None
+        return str(self.labels[best])
+
+
+# Deterministic stand-in for tests: the answer depends only on the clip's samples. Specific clips can be
+# given fixed answers by passing {sha1 of the clip's bytes: word (or None)}.
+class FakeRecognizer(ResponseRecognizer):
+    name = "fake"
+    version = "1"
+    WORDS = ("YES", "NO", None)
+
+    def __init__(self, answers=None):
+        self.answers = {} if answers is None else answers
+
+    def cache_id(self):
+        digest = hashlib.sha1(repr(sorted(self.answers.items())).encode()).hexdigest()
+        return f"{self.name}-{self.version}-{digest[:12]}"
+
+    def recognize(self, pcm16, frame_rate):
+        digest = hashlib.sha1(np.ascontiguousarray(pcm16, dtype=np.int16).tobytes()).hexdigest()
+        if digest in self.answers:
+            return self.answers[digest]
+        return self.WORDS[int(digest, 16) % len(self.WORDS)]
+
+
+BACKENDS = {cls.name: cls for cls in (GoogleRecognizer, TemplateRecognizer, FakeRecognizer)}
+
+
+# Create a recognizer backend by name ("google", "template" or "fake")
+def make_recognizer(backend, **kwargs):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown recognizer backend '{backend}' (choose from {', '.join(BACKENDS)})")
+    return BACKENDS[backend](**kwargs)
+
+
+if __name__ == "__main__":
+    import csv
+    import os
+    import soundfile
+    import clip_archive
+
+    # Enroll templates from a results file whose "User response" column has been reviewed, reading the clips
+    # from the trial's clip archive if it has one
+    labels = []
+    clips = []
+    frame_rate = None
+    archive = clip_archive.ClipArchive(TRIAL_NAME) if clip_archive.uses_clip_archive(TRIAL_NAME) else None
+    with open(RESULTS_CSV_FILENAME) as results_file:
+        reader = csv.reader(results_file)
+        header = next(reader)
+        for row in reader:
+            if len(row) == 0 or row[2] not in ("YES", "NO"):
+                continue
+            if archive is not None:
+                clip, frame_rate = archive.clip(int(row[6])), archive.frame_rate
+            else:
+                clip, frame_rate = soundfile.read(os.path.join(CLIP_SEPERATION_PATH, f"chunk{int(row[6])}.wav"),
+                                                  dtype='int16')
+            clips.append(clip)
+            labels.append(row[2])
+    recognizer = TemplateRecognizer()
+    recognizer.enroll(clips, labels, frame_rate)
+    recognizer.save(TEMPLATE_FILE)
+    print(f"Enrolled {len(clips)} clips ({', '.join(recognizer.labels)}) into {TEMPLATE_FILE}")
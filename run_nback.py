@@ -1,12 +1,13 @@
 #!/usr/bin/env python
-import ctypes
-import datetime
-from time import sleep
-import cv2
+import time
 import numpy as np
-import sounddevice as sd
 from scipy.io import wavfile, loadmat
-import csv
+import live_detection
+import response_matching
+import session_store
+import stimulus_scheduler
+import streaming_recorder
+import stimulus_frames
 
 """ ~~~~~~~~~~~~~     TUNABLE PARAMETERS     ~~~~~~~~~~~~~ """
 # Name of the matlab file containing the test sequence
@@ -18,9 +19,6 @@ N = 2
 # Name of given trial
 TRIAL_NAME = "nback_test"
 
-# Colors dictionary that identifies the RGB values of the used colors
-LETTERS = np.array(["A", "B", "C", "D", "E", "H", "I", "K", "L", "M", "O", "P", "R", "S", "T"], dtype=str)
-
 # Frequency of matching n back letters is 1:FREQUENCY (FREQUENCY = 4 means 1 in 4 responses should be "Yes")
 FREQUENCY = 4
 
@@ -30,129 +28,185 @@ NUM_TESTS = 20
 # The minimum period, in milliseconds, that could distinguish two different responses
 STIMULUS_INTERVAL_S = 0.75
 INTERIAL_INTERVAL_S = 2.00
-"""~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~"""
-
-# Get screen dimensions
-user32 = ctypes.windll.user32
-screensize = user32.GetSystemMetrics(0), user32.GetSystemMetrics(1)
 
-# Make sure cv2 images are displayed in full screen
-window_name = 'projector'
-cv2.namedWindow(window_name, cv2.WND_PROP_FULLSCREEN)
-cv2.moveWindow(window_name, screensize[1] - 1, screensize[0] - 1)
-cv2.setWindowProperty(window_name, cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
-
-# Create a blank white image as a template
-img = np.full((screensize[1], screensize[0], 3), fill_value=255, dtype=np.uint8)
+# Save the recording to disk block by block while it records, instead of holding the whole session in memory
+# (the saved file is the same either way). Audio is read in blocks of RECORDING_BLOCK_SIZE frames, and up to
+# RECORDING_RING_BLOCKS blocks can wait to be saved before any are dropped.
+STREAM_RECORDING = True
+RECORDING_BLOCK_SIZE = 1024
+RECORDING_RING_BLOCKS = 64
+
+# Detect the user's responses while the test runs (requires STREAM_RECORDING), saving them to the session store
+# (and with their reaction times to <TRIAL_NAME>_onsets.csv) as soon as it ends (process_nback.py can then skip
+# detection with USE_LIVE_ONSETS)
+LIVE_DETECTION = False
+# With LIVE_DETECTION, also save each response as a clip in <TRIAL_NAME>_reponse_chunks as it happens
+LIVE_SAVE_CLIPS = False
+# Minimum period of silence (ms) separating two responses (should match process_nback.py)
+MIN_PERIOD_SILENCE_MS = 500
+
+# Directory where rendered stimulus frames are kept between runs (None to render them every time)
+FRAME_CACHE_DIR = "frame_cache"
+"""~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~"""
 
 # Define text parameters for stimuli images
-font = cv2.FONT_HERSHEY_SIMPLEX
 fontScale = 15.0
 fontThickness = 40
 countDownFontScale = 7.0
 coutDownFontThickness = 28
 
 
+# Get screen dimensions
+def screen_size():
+    import ctypes
+    user32 = ctypes.windll.user32
+    return user32.GetSystemMetrics(0), user32.GetSystemMetrics(1)
+
+
+# The full screen projector window stimuli are shown on. cv2 is only needed (and the window only opened)
+# once one is created, so this module can be imported without a display.
+class ProjectorDisplay:
+    def __init__(self, window_name='projector'):
+        import cv2
+        self.cv2 = cv2
+        self.window_name = window_name
+        self.width, self.height = screen_size()
+
+        # Make sure cv2 images are displayed in full screen
+        cv2.namedWindow(window_name, cv2.WND_PROP_FULLSCREEN)
+        cv2.moveWindow(window_name, self.height - 1, self.width - 1)
+        cv2.setWindowProperty(window_name, cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
+
+    # Renders the stimuli for this display, keeping them in FRAME_CACHE_DIR between runs
+    def frame_cache(self):
+        return stimulus_frames.FrameCache(self.width, self.height, self.cv2.FONT_HERSHEY_SIMPLEX,
+                                          cache_dir=FRAME_CACHE_DIR)
+
+    # Draw an image on the projector window
+    def show(self, image):
+        self.cv2.imshow(self.window_name, image)
+        self.cv2.waitKey(1)
+
+    def close(self):
+        self.cv2.destroyAllWindows()
+
+
+# Give user a countdown
+def countdown(display, frame_cache, sleep=time.sleep):
+    for word in ["Get Ready...", "3..", "2..", "1..", "GO!!!"]:
+        # Wait out a 1s delay, then destory the image
+        display.show(frame_cache.get(word, countDownFontScale, coutDownFontThickness))
+        sleep(1.0)
+    sleep(0.5)
+
+
+# Displays the text to the user for given number of iterations, the first one a second after the scheduler's
+# start (the start of the recording), with a blank image in between
+def present_stimuli(display, stimuli_images, stimuli_frame_indices, blank_image, scheduler, num_tests=NUM_TESTS,
+                    stimulus_interval_s=STIMULUS_INTERVAL_S, interial_interval_s=INTERIAL_INTERVAL_S):
+    for i in range(num_tests):
+        onset_s = 1.0 + i * (stimulus_interval_s + interial_interval_s)
+        # Show image add the given array position to the user, recording when it actually appeared
+        scheduler.present(onset_s, lambda: display.show(stimuli_images[stimuli_frame_indices[i]]))
+        # Show blank image in between stimuli once the stimulus interval is up
+        scheduler.present(onset_s + stimulus_interval_s, lambda: display.show(blank_image), record=False)
+    # Wait out the last inter-trial interval
+    scheduler.wait_until(num_tests * (stimulus_interval_s + interial_interval_s) + 1.0)
+
+
+# Save what was shown, and when, to the session store, and export it as a csv. Given the StreamingRecorder that
+# recorded the session, the stimulus times are placed on the recording using the timestamps of its audio
+# blocks (so they account for input latency and for when the stream actually started), and how they were
+# aligned is saved with them. Otherwise they are relative to the start of the stimulus schedule. Returns the
+# session.
+def save_presentation(trial_name, n, letter_sequence, answer_array, scheduler, response_timing_chunks=None,
+                      response_window_s=STIMULUS_INTERVAL_S + INTERIAL_INTERVAL_S, recorder=None):
+    # The time at which each stimulus was displayed with respect to the start of the recording, the time it was
+    # meant to be displayed, and how far off it was overall
+    stimuli_time_stamps = np.array(scheduler.actual)
+    intended_time_stamps = np.array(scheduler.intended)
+    alignment_fields = {}
+    if recorder is not None:
+        stimuli_time_stamps = recorder.recording_times(scheduler.start_time + stimuli_time_stamps)
+        intended_time_stamps = recorder.recording_times(scheduler.start_time + intended_time_stamps)
+        recording_start_s = -float(recorder.recording_times(scheduler.start_time))
+        alignment_fields = {"recording_start_s": recording_start_s, "input_latency_s": recorder.input_latency_s,
+                            "sample_clock_ratio": recorder.sample_clock_ratio()}
+        print("First sample recorded %.2f ms from the start of the stimulus schedule (input latency %.2f ms)"
+              % (recording_start_s * 1000.0, recorder.input_latency_s * 1000.0))
+    onset_errors_ms = scheduler.onset_errors() * 1000.0
+    jitter_stats_ms = [stat * 1000.0 for stat in scheduler.jitter_stats()]
+    print("Stimulus onset error: mean %.2f ms, SD %.2f ms, max %.2f ms" % tuple(jitter_stats_ms))
+
+    # Save the session to its store, and export it as a csv
+    num_tests = len(stimuli_time_stamps)
+    live_fields = {"live_chunks": response_timing_chunks} if response_timing_chunks is not None else {}
+    session = session_store.save_session(trial_name, replace=True, n=n, letters=letter_sequence[:num_tests],
+                                         answers=answer_array[:num_tests], stimulus_times=stimuli_time_stamps,
+                                         intended_times=intended_time_stamps, onset_errors_ms=onset_errors_ms,
+                                         **live_fields, **alignment_fields)
+    session_store.export_trial_csv(trial_name, session)
+    if response_timing_chunks is not None:
+        response_matching.write_onsets(trial_name + "_onsets.csv", response_timing_chunks, stimuli_time_stamps, n,
+                                       response_window_s)
+    return session
+
+
 if __name__ == "__main__":
     # Get test sequence from mat file
     mat = loadmat(MAT_FILE_NAME)
     letter_sequence = mat["Sequence"]
     answer_array = mat["Answers"]
 
-    # Creates an array that contains the global time for each time stamp
-    stimuli_time_stamps = np.empty(NUM_TESTS, dtype=datetime.datetime)
+    # Render a frame for each letter the sequence uses (or load it from the frame cache), and find which frame
+    # each stimulus shows up front
+    display = ProjectorDisplay()
+    frame_cache = display.frame_cache()
+    stimuli_images, stimuli_frame_indices = frame_cache.sequence_frames(letter_sequence[:NUM_TESTS], fontScale,
+                                                                        fontThickness)
+    # Create a blank white image as a template
+    img = np.full((display.height, display.width, 3), fill_value=255, dtype=np.uint8)
 
-    # Create an array of stimuli images
-    stimuli_images = []
-    for i in range(len(LETTERS)):
-        # Copy the template image
-        new_img = np.copy(img)
-
-        # Determine text size from given word
-        textsize = cv2.getTextSize(LETTERS[i], font, 1, 2)[0]
-
-        # Define parameters for positioning text on a given blank image
-        textX = int((img.shape[1] - textsize[0] * fontScale) / 2)
-        textY = int((img.shape[0] + textsize[1] * fontScale) / 2)
-        bottomLeftCornerOfText = (textX, textY)
-
-        # Position text on the screen
-        cv2.putText(new_img, LETTERS[i],
-                    bottomLeftCornerOfText,
-                    font,
-                    fontScale,
-                    color=(0, 0, 0),
-                    thickness=fontThickness)
-
-        # Add the image to the array
-        stimuli_images.append(new_img)
-
-    # Give user a countdown
-    for word in ["Get Ready...", "3..", "2..", "1..", "GO!!!"]:
-        # Copy blank image from template
-        new_img = np.copy(img)
-
-        # Determine text size
-        textsize = cv2.getTextSize(word, font, 1, 2)[0]
-
-        # Define parameters for positioning text on template image
-        textX = int((img.shape[1] - textsize[0] * countDownFontScale) / 2)
-        textY = int((img.shape[0] + textsize[1] * countDownFontScale) / 2)
-        bottomLeftCornerOfText = (textX, textY)
-
-        # Position text on the screen
-        cv2.putText(new_img, word,
-                    bottomLeftCornerOfText,
-                    font,
-                    countDownFontScale,
-                    color=(0, 0, 0),  # make the words black
-                    thickness=coutDownFontThickness)
-
-        # Wait out a 1s delay, then destory the image
-        cv2.imshow(window_name, new_img)
-        cv2.waitKey(1)
-        sleep(1.0)
-    sleep(0.5)
+    countdown(display, frame_cache)
 
     # Define recording parameters and start recording
     rec_seconds = int(NUM_TESTS) * (INTERIAL_INTERVAL_S + STIMULUS_INTERVAL_S) + 10
     sample_rate = 44100
-    myrecording = sd.rec(int(rec_seconds * sample_rate), samplerate=sample_rate, channels=1)
-    recording_start_time = datetime.datetime.now()
-    sleep(1)
-
-    # Displays the text to the user for given number of iterations
-    for i in range(NUM_TESTS):
-        # Show image add the given array position to the user
-        cv2.imshow(window_name, stimuli_images[np.where(LETTERS == letter_sequence[i])[0][0]])
-        # Get global time of stimulus
-        stimuli_time_stamps[i] = datetime.datetime.now()
-        # Wait out the given delay, then destory the image
-        cv2.waitKey(1)
-        sleep(STIMULUS_INTERVAL_S)
-        # Show blank image in between stimuli
-        cv2.imshow(window_name, img)
-        # Wait out the given delay, then destory the image
-        cv2.waitKey(1)
-        sleep(INTERIAL_INTERVAL_S)
+    if STREAM_RECORDING:
+        recorder = streaming_recorder.StreamingRecorder(TRIAL_NAME + '.wav', sample_rate, channels=1,
+                                                        block_size=RECORDING_BLOCK_SIZE,
+                                                        ring_blocks=RECORDING_RING_BLOCKS,
+                                                        max_frames=int(rec_seconds * sample_rate))
+        if LIVE_DETECTION:
+            detector = live_detection.LiveDetector(sample_rate, min_silence_len=MIN_PERIOD_SILENCE_MS,
+                                                   clip_dir=TRIAL_NAME + "_reponse_chunks" if LIVE_SAVE_CLIPS else None)
+            recorder.on_block = detector.process
+        recorder.start()
+    else:
+        import sounddevice as sd
+        myrecording = sd.rec(int(rec_seconds * sample_rate), samplerate=sample_rate, channels=1)
+    # All stimulus onsets are scheduled at absolute times on a monotonic clock, from about the recording start
+    # (the recorder measures exactly where on the recording they are)
+    scheduler = stimulus_scheduler.StimulusScheduler()
+    present_stimuli(display, stimuli_images, stimuli_frame_indices, img, scheduler)
 
     # Destroy last displayed image
-    cv2.destroyAllWindows()
+    display.close()
 
     # Stop the recording, save file as .wav
     print("Waiting for recording to stop...")
-    sd.wait()
-    wavfile.write(TRIAL_NAME + '.wav', sample_rate, myrecording)  # Save as WAV file
+    response_timing_chunks = None
+    if STREAM_RECORDING:
+        # The recording is already on disk once the full length has been saved
+        recorder.wait()
+        print(recorder.summary())
+        if LIVE_DETECTION:
+            response_timing_chunks = detector.finish()
+    else:
+        sd.wait()
+        wavfile.write(TRIAL_NAME + '.wav', sample_rate, myrecording)  # Save as WAV file
     print("Done. Saving data...")
 
-    # Calculate the time at which each stimulus is displayed with respect to the start of the recording
-    stimuli_time_stamps = np.array(
-        [(stimuli_time_stamps[i] - recording_start_time).total_seconds() for i in range(NUM_TESTS)])
-
-    # Write results to file
-    with open(TRIAL_NAME + ".csv", 'w') as reac_file:
-        writer = csv.writer(reac_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        writer.writerow(['Letter', 'Correct answer', 'Stimuli time from start (s)'])
-        for i in range(NUM_TESTS):
-            writer.writerow([letter_sequence[i], answer_array[i], stimuli_time_stamps[i]])
+    save_presentation(TRIAL_NAME, N, letter_sequence, answer_array, scheduler, response_timing_chunks,
+                      recorder=recorder if STREAM_RECORDING else None)
     print("Done.")
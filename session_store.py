@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+import csv
+import os
+import numpy as np
+import response_matching
+
+# Everything known about a session is kept in one <trial>_session.npz, one typed array per field, so it can be
+# loaded in a single read. The CSVs that run_nback.py and process_nback.py used to exchange are still written,
+# but only as exports for people to read.
+SCHEMA_VERSION = 1
+
+# Field name: (dtype, description). Per-stimulus fields all have one entry per stimulus shown.
+SCHEMA = {
+    "n": (np.int64, "The N value of the session"),
+    # Written by run_nback.py
+    "letters": (np.str_, "Letter shown at each stimulus"),
+    "answers": (np.str_, "Correct answer to each stimulus (Y or N)"),
+    "stimulus_times": (np.float64, "Time each stimulus appeared, from the start of the recording (s)"),
+    "intended_times": (np.float64, "Time each stimulus was scheduled to appear (s)"),
+    "onset_errors_ms": (np.float64, "Actual minus intended onset of each stimulus (ms)"),
+    "live_chunks": (np.int64, "(start, end) of each response detected while recording (ms)"),
+    "recording_start_s": (np.float64, "When the first sample of the recording was captured, from the start of the "
+                                      "stimulus schedule (s)"),
+    "input_latency_s": (np.float64, "Input latency the audio device reported (s)"),
+    "sample_clock_ratio": (np.float64, "Seconds of the stimulus clock per second of recording"),
+    # Written by process_nback.py and amend_nback.py
+    "chunks": (np.int64, "(start, end) of each response used for matching (ms)"),
+    "response_onsets": (np.float64, "Time each response starts, from the start of the recording (s)"),
+    "clip_index": (np.int64, "Response matched to each stimulus (response_matching.NO_CLIP if none)"),
+    "reaction_times": (np.float64, "Reaction time to each stimulus (s, nan if unmatched)"),
+    "responses": (np.str_, "Recognized response to each stimulus (empty if none)"),
+    "correct": (np.int8, "Whether each response was correct (1, 0, or -1 if there was no response)"),
+    "on_time": (np.bool_, "Whether each response came within the response window"),
+    "clip_files": (np.bool_, "Whether each response clip was saved as its own wav in <trial>_reponse_chunks"),
+    "clip_archive": (np.bool_, "Whether the response clips were saved as one clip archive (see clip_archive) "
+                               "rather than one wav each"),
+    "silence_threshold_db": (np.float64, "Silence threshold chosen for the recording, if calibrated (dBFS)"),
+    "noise_floor_db": (np.float64, "Estimated background noise level of the recording, if calibrated (dBFS)"),
+    "speech_level_db": (np.float64, "Estimated speech level of the recording, if calibrated (dBFS)"),
+    # Written by synthetic_session.py
+    "synthetic_onsets": (np.float64, "True start of each response in a synthesized recording (s)"),
+}
+
+
+def session_filename(trial_name):
+    return trial_name + "_session.npz"
+
+
+# Accuracy strings (TRUE, FALSE or N/A, as returned by response_matching.score_responses) as the correct field
+def accuracies_to_correct(accuracies):
+    accuracies = np.asarray(accuracies, dtype=str)
+    return np.where(accuracies == "TRUE", 1, np.where(accuracies == "FALSE", 0, -1)).astype(np.int8)
+
+
+def correct_to_accuracies(correct):
+    correct = np.asarray(correct)
+    return np.where(correct == 1, "TRUE", np.where(correct == 0, "FALSE", "N/A"))
+
+
+# Cast each field to its type in the schema, rejecting fields the schema doesn't know about
+def _validate(fields):
+    validated = {}
+    for name, value in fields.items():
+        if name not in SCHEMA:
+            raise KeyError(f"{name} is not a session field")
+        validated[name] = np.asarray(value, dtype=SCHEMA[name][0])
+    return validated
+
+
+# Load every field of a session as a dict of arrays. Sessions recorded before the store existed are read from
+# their CSVs instead.
+def load_session(trial_name):
+    filename = session_filename(trial_name)
+    if not os.path.isfile(filename):
+        return import_legacy_csvs(trial_name)
+    with np.load(filename, allow_pickle=False) as store:
+        version = int(store["schema_version"])
+        if version > SCHEMA_VERSION:
+            raise ValueError(f"{filename} was written with a newer session schema (version {version})")
+        return {name: store[name] for name in store.files if name in SCHEMA}
+
+
+# Add (or replace) fields of a session's store, keeping the rest unless replace is set (for a new recording).
+# Saving to a session recorded before the store existed creates its store from its CSVs first. The store is
+# replaced in one step, so a crash can't leave it half written.
+def save_session(trial_name, replace=False, **fields):
+    session = {}
+    if not replace and (os.path.isfile(session_filename(trial_name)) or os.path.isfile(trial_name + ".csv")):
+        session = load_session(trial_name)
+    session.update(_validate(fields))
+    filename = session_filename(trial_name)
+    temp_filename = filename[:-len(".npz")] + ".tmp.npz"
+    np.savez(temp_filename, schema_version=SCHEMA_VERSION, **session)
+    os.replace(temp_filename, filename)
+    return session
+
+
+# Build a session from the CSVs written before the store existed: <trial>.csv and, if the trial has been
+# processed, <trial>_RESULTS.csv
+def import_legacy_csvs(trial_name):
+    with open(trial_name + ".csv") as trial_file:
+        reader = csv.reader(trial_file)
+        header = next(reader)
+        data = np.array([row for row in reader if len(row) > 0], dtype=str).reshape(-1, len(header))
+    session = {"letters": data[:, 0], "answers": data[:, 1], "stimulus_times": data[:, 2].astype(float)}
+    if len(header) >= 5:
+        session["intended_times"] = data[:, 3].astype(float)
+        session["onset_errors_ms"] = data[:, 4].astype(float)
+
+    if os.path.isfile(trial_name + "_RESULTS.csv"):
+        with open(trial_name + "_RESULTS.csv") as results_file:
+            reader = csv.reader(results_file)
+            header = next(reader)
+            data = np.array([row for row in reader if len(row) > 0], dtype=str).reshape(-1, len(header))
+        # Rows past the last stimulus or response are padded with -1
+        stimuli = data[data[:, 0] != '-1']
+        markers = data[:, 9].astype(float)
+        session.update(response_onsets=markers[markers != -1.0], clip_index=stimuli[:, 6].astype(int),
+                       reaction_times=stimuli[:, 4].astype(float),
+                       responses=np.where(stimuli[:, 2] == "N/A", "", stimuli[:, 2]),
+                       correct=accuracies_to_correct(stimuli[:, 3]), on_time=stimuli[:, 5] == "True")
+    return _validate(session)
+
+
+# Export the stimuli of a session as <trial>.csv
+def export_trial_csv(trial_name, session):
+    num_stimuli = len(session["letters"])
+    onset_errors_ms = session.get("onset_errors_ms", np.full(num_stimuli, np.nan))
+    intended_times = session.get("intended_times", np.full(num_stimuli, np.nan))
+    jitter_stats_ms = [np.mean(onset_errors_ms), np.std(onset_errors_ms), np.max(np.abs(onset_errors_ms))] \
+        if num_stimuli else []
+    with open(trial_name + ".csv", 'w') as reac_file:
+        writer = csv.writer(reac_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(['Letter', 'Correct answer', 'Stimuli time from start (s)', 'Intended time from start (s)',
+                         'Onset error (ms)', ' ', 'Mean onset error (ms)', 'Onset error SD (ms)',
+                         'Max onset error (ms)'])
+        for i in range(num_stimuli):
+            # Jitter statistics for the whole session are filled in on the first row only
+            jitter_columns = jitter_stats_ms if i == 0 else [' ', ' ', ' ']
+            writer.writerow([session["letters"][i], session["answers"][i], session["stimulus_times"][i],
+                             intended_times[i], onset_errors_ms[i], ' '] + jitter_columns)
+
+
+# Export the results of a processed session as <trial>_RESULTS.csv
+def export_results_csv(trial_name, session):
+    responses = session["responses"]
+    raw_responses = np.where(responses == "", "N/A", responses).astype(object)
+    response_matching.write_results(trial_name + "_RESULTS.csv", session["letters"], session["answers"],
+                                    raw_responses, correct_to_accuracies(session["correct"]),
+                                    session["reaction_times"], session["on_time"], session["clip_index"],
+                                    session["response_onsets"])
+
+
+# Summarize a processed session as one row of a combined summary table
+def summarize_session(trial_name, n):
+    session = load_session(trial_name)
+    n = int(session.get("n", n))
+    return response_matching.summarize_trial(trial_name, n, correct_to_accuracies(session["correct"]),
+                                             session["reaction_times"], session["on_time"],
+                                             len(session["response_onsets"]))
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+import numpy as np
+import response_matching
+import speech_detection
+
+# Length (ms) of the frames whose levels make up the histogram
+FRAME_MS = 10
+# Recordings whose speech is less than this far (dB) above the noise floor are treated as having no speech
+MIN_SPEECH_MARGIN_DB = 6.0
+# Without stimuli to check against, the threshold is placed this fraction of the way from the noise floor
+# up to the speech level (in dB)
+DEFAULT_THRESHOLD_FRACTION = 0.35
+
+
+# Raised when a recording has no level that separates speech from background noise
+class CalibrationError(Exception):
+    pass
+
+
+# Level (dBFS) of every FRAME_MS frame of a recording, measured speech_detection.BLOCK_MS at a time so memory
+# use doesn't grow with the length of the recording
+def frame_levels_db(samples, frame_rate, max_amplitude, frame_ms=FRAME_MS):
+    total_ms = speech_detection.duration_ms(len(samples), frame_rate)
+    frame_starts = np.arange(0, max(total_ms - frame_ms, 0) + 1, frame_ms)
+    block_frames = max(speech_detection.BLOCK_MS // frame_ms, 1)
+    rms = np.concatenate([speech_detection.window_rms(samples, frame_rate, frame_starts[i:i + block_frames], frame_ms)
+                          for i in range(0, len(frame_starts), block_frames)])
+    return 20 * np.log10(np.maximum(rms, 1e-10) / max_amplitude)
+
+
+# Estimate the noise floor and speech level (dBFS) of a recording from the histogram of its frame levels, in
+# 1 dB bins. Most of an N-back recording is background noise, so the noise floor is the most common level
+# among the quieter half of the frames; the speech level is the 95th percentile.
+def estimate_levels(levels_db):
+    levels_db = np.clip(np.round(levels_db), -150, 0).astype(int)
+    counts = np.bincount(levels_db + 150, minlength=151)
+    cumulative_counts = np.cumsum(counts)
+    median_bin = np.searchsorted(cumulative_counts, 0.5 * cumulative_counts[-1])
+    noise_floor_db = float(np.argmax(counts[:median_bin + 1]) - 150)
+    speech_level_db = float(np.searchsorted(cumulative_counts, 0.95 * cumulative_counts[-1]) - 150)
+    return noise_floor_db, speech_level_db
+
+
+# Choose a silence threshold (dBFS, for detect_nonsilent on the recording as it is) for one recording.
+# Candidate thresholds between its noise floor and speech level are tried; given the stimuli, the one that
+# lets the most stimuli be matched to a response is chosen (then the one detecting closest to one response
+# per stimulus that warrants one), otherwise the one DEFAULT_THRESHOLD_FRACTION of the way up.
+# Returns (threshold_db, noise_floor_db, speech_level_db).
+def calibrate_threshold(samples, frame_rate, max_amplitude, min_silence_len, stimuli_time_stamps=None, n=0,
+                        response_window_s=None, num_candidates=25):
+    noise_floor_db, speech_level_db = estimate_levels(frame_levels_db(samples, frame_rate, max_amplitude))
+    if speech_level_db - noise_floor_db < MIN_SPEECH_MARGIN_DB:
+        raise CalibrationError(f"Could not tell speech from background noise (noise floor {noise_floor_db:.0f} dB, "
+                               f"speech level {speech_level_db:.0f} dB)")
+    default_db = noise_floor_db + DEFAULT_THRESHOLD_FRACTION * (speech_level_db - noise_floor_db)
+    if stimuli_time_stamps is None:
+        return default_db, noise_floor_db, speech_level_db
+
+    candidates_db = np.linspace(noise_floor_db + MIN_SPEECH_MARGIN_DB / 2, speech_level_db - MIN_SPEECH_MARGIN_DB / 2,
+                                num_candidates)
+    chunks = speech_detection.detect_nonsilent_grid(samples, frame_rate, [min_silence_len],
+                                                    speech_detection.db_to_ratio(candidates_db) * max_amplitude)[0]
+    expected_responses = max(len(stimuli_time_stamps) - n, 0)
+    scores = []
+    for j, threshold_db in enumerate(candidates_db):
+        markers = chunks[j][:, 0] / 1000.0
+        markers = markers[markers != 0.0]
+        clip_index, reaction_times = response_matching.match_responses(stimuli_time_stamps, markers, n,
+                                                                       response_window_s)
+        scores.append((np.count_nonzero(clip_index >= 0), -abs(len(markers) - expected_responses),
+                       -abs(threshold_db - default_db)))
+    best = max(range(len(candidates_db)), key=lambda j: scores[j])
+    return float(candidates_db[best]), noise_floor_db, speech_level_db
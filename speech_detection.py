@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+import numpy as np
+
+# Number of windows (one per millisecond) detect_silence measures at a time, so only that much of a long
+# recording (plus one window) is read into memory at once
+BLOCK_MS = 60000
+
+
+# Convert a dBFS level to a linear amplitude ratio (same conversion pydub uses for silence_thresh)
+def db_to_ratio(db):
+    return 10 ** (db / 20.0)
+
+
+# Pull the raw samples out of a pydub AudioSegment as a (frames, channels) array along with the info
+# needed to interpret them
+def audio_segment_samples(audio_segment):
+    samples = np.array(audio_segment.get_array_of_samples()).reshape(-1, audio_segment.channels)
+    return samples, audio_segment.frame_rate, audio_segment.max_possible_amplitude
+
+
+# Memory-map the samples of a WAV file as a (frames, channels) array without reading them, along with the
+# same info as audio_segment_samples. Only the parts of the recording that are used get read from disk.
+def wav_samples(filename):
+    from scipy.io import wavfile
+    try:
+        frame_rate, samples = wavfile.read(filename, mmap=True)
+    except ValueError:
+        # 24-bit audio can't be mapped directly
+        frame_rate, samples = wavfile.read(filename)
+    if samples.ndim == 1:
+        samples = samples[:, np.newaxis]
+    max_amplitude = 1.0 if samples.dtype.kind == "f" else 2 ** (8 * samples.dtype.itemsize - 1)
+    return samples, frame_rate, max_amplitude
+
+
+# Length of a recording in whole milliseconds, rounded the same way pydub reports len(audio_segment)
+def duration_ms(num_frames, frame_rate):
+    return int(round(1000.0 * num_frames / frame_rate))
+
+
+# Frame index that a millisecond offset maps to (mirrors pydub's slicing of an AudioSegment)
+def ms_to_frame(ms, frame_rate):
+    return (np.asarray(ms) * (frame_rate / 1000.0)).astype(np.int64)
+
+
+# Compute the RMS of every window of window_ms milliseconds starting at each offset in window_starts_ms.
+# A cumulative sum of squared samples makes each window O(1), so the whole envelope is linear in the
+# length of the recording no matter how long the window is. Only the frames the windows cover are read, so
+# samples may be a memory-mapped recording.
+def window_rms(samples, frame_rate, window_starts_ms, window_ms):
+    if samples.ndim == 1:
+        samples = samples[:, np.newaxis]
+    num_frames, num_channels = samples.shape
+    total_ms = duration_ms(num_frames, frame_rate)
+
+    window_starts_ms = np.asarray(window_starts_ms, dtype=np.int64)
+    start_frames = np.minimum(ms_to_frame(np.minimum(window_starts_ms, total_ms), frame_rate), num_frames)
+    end_frames = np.minimum(ms_to_frame(np.minimum(window_starts_ms + window_ms, total_ms), frame_rate), num_frames)
+    lengths = (end_frames - start_frames) * num_channels
+
+    # Running total of the energy in each frame (summed across channels) from the first frame any window
+    # covers; exact in int64 for <= 16-bit audio
+    first_frame = int(start_frames.min()) if len(start_frames) else 0
+    last_frame = int(end_frames.max()) if len(end_frames) else 0
+    covered = np.asarray(samples[first_frame:last_frame])
+    if samples.dtype.kind in "iu" and samples.dtype.itemsize <= 2:
+        squares = np.square(covered, dtype=np.int64).sum(axis=1)
+    else:
+        squares = np.square(covered, dtype=np.float64).sum(axis=1)
+    energy = np.concatenate(([0], np.cumsum(squares)))
+    start_frames = start_frames - first_frame
+    end_frames = end_frames - first_frame
+
+    # Empty windows have an RMS of 0, like an empty AudioSegment
+    rms = np.zeros(len(window_starts_ms), dtype=np.float64)
+    valid = lengths > 0
+    rms[valid] = np.sqrt((energy[end_frames[valid]] - energy[start_frames[valid]]) / lengths[valid])
+    if samples.dtype.kind in "iu":
+        # audioop truncates the RMS of integer audio to an integer
+        rms = np.floor(rms)
+    return rms
+
+
+# Start (ms) of every min_silence_len window checked at each seek step, making sure the end of the audio is
+# searched
+def window_starts(seg_len, min_silence_len, seek_step=1):
+    last_slice_start = seg_len - min_silence_len
+    slice_starts = np.arange(0, last_slice_start + 1, seek_step, dtype=np.int64)
+    if last_slice_start % seek_step:
+        slice_starts = np.append(slice_starts, last_slice_start)
+    return slice_starts
+
+
+# Silent ranges [start, end] (in ms) for each of several thresholds (linear RMS values on the scale of
+# samples). The windows are measured BLOCK_MS at a time, and every threshold is applied to each block before
+# the next is measured, so memory use doesn't grow with the length of the recording or the number of
+# thresholds. Returns one (n, 2) array per threshold.
+def silent_ranges(samples, frame_rate, min_silence_len, thresholds, seek_step=1):
+    seg_len = duration_ms(len(samples), frame_rate)
+
+    # You can't have a silent portion of a sound that is longer than the sound
+    if seg_len < min_silence_len:
+        return [np.empty((0, 2), dtype=np.int64) for threshold in thresholds]
+    slice_starts = window_starts(seg_len, min_silence_len, seek_step)
+
+    # Silent windows that overlap (or touch) are combined into a single silent range; a range still open at
+    # the end of a block carries over into the next
+    range_starts = [[] for threshold in thresholds]
+    range_ends = [[] for threshold in thresholds]
+    open_ranges = [None] * len(thresholds)
+    block_windows = max(BLOCK_MS // seek_step, 1)
+    for block_start in range(0, len(slice_starts), block_windows):
+        block_starts = slice_starts[block_start:block_start + block_windows]
+        rms = window_rms(samples, frame_rate, block_starts, min_silence_len)
+        for j, threshold in enumerate(thresholds):
+            silence_starts = block_starts[rms <= threshold]
+            if len(silence_starts) == 0:
+                continue
+            open_range = open_ranges[j]
+            if open_range is not None:
+                silence_starts = np.concatenate(([open_range[1]], silence_starts))
+            breaks = np.flatnonzero(np.diff(silence_starts) > min_silence_len)
+            starts = silence_starts[np.concatenate(([0], breaks + 1))]
+            lasts = silence_starts[np.concatenate((breaks, [len(silence_starts) - 1]))]
+            if open_range is not None:
+                starts[0] = open_range[0]
+            range_starts[j].append(starts[:-1])
+            range_ends[j].append(lasts[:-1] + min_silence_len)
+            open_ranges[j] = (starts[-1], lasts[-1])
+
+    ranges = []
+    for j, open_range in enumerate(open_ranges):
+        if open_range is None:
+            ranges.append(np.empty((0, 2), dtype=np.int64))
+            continue
+        range_starts[j].append([open_range[0]])
+        range_ends[j].append([open_range[1] + min_silence_len])
+        ranges.append(np.column_stack((np.concatenate(range_starts[j]),
+                                       np.concatenate(range_ends[j]))).astype(np.int64))
+    return ranges
+
+
+# Find the silent sections [start, end] (in ms) of a recording. Equivalent to pydub's silence.detect_silence,
+# but computed with one vectorized pass instead of re-measuring a full window at every seek step.
+def detect_silence(samples, frame_rate, max_amplitude, min_silence_len=1000, silence_thresh=-16, seek_step=1):
+    return silent_ranges(samples, frame_rate, min_silence_len, [db_to_ratio(silence_thresh) * max_amplitude],
+                         seek_step)[0]
+
+
+# The nonsilent sections [start, end] (in ms) between the silent ranges of a recording seg_len ms long
+def nonsilent_ranges(silences, seg_len):
+    # If there is no silence, the whole thing is nonsilent
+    if len(silences) == 0:
+        return np.array([[0, seg_len]], dtype=np.int64)
+
+    # Short circuit when the whole recording is silent
+    if silences[0, 0] == 0 and silences[0, 1] == seg_len:
+        return np.empty((0, 2), dtype=np.int64)
+
+    # Nonsilence is whatever lies between consecutive silent ranges
+    starts = np.concatenate(([0], silences[:, 1]))
+    ends = np.concatenate((silences[:, 0], [seg_len]))
+    if silences[-1, 1] == seg_len:
+        starts, ends = starts[:-1], ends[:-1]
+    chunks = np.column_stack((starts, ends))
+    if chunks[0, 0] == 0 and chunks[0, 1] == 0:
+        chunks = chunks[1:]
+    return chunks
+
+
+# Find the nonsilent sections [start, end] (in ms) of a recording. Returns the same chunks as pydub's
+# silence.detect_nonsilent, as an (n, 2) integer array.
+def detect_nonsilent(samples, frame_rate, max_amplitude, min_silence_len=1000, silence_thresh=-16, seek_step=1):
+    return nonsilent_ranges(detect_silence(samples, frame_rate, max_amplitude, min_silence_len, silence_thresh,
+                                           seek_step), duration_ms(len(samples), frame_rate))
+
+
+# Convenience wrapper that runs detect_nonsilent directly on a pydub AudioSegment
+def detect_nonsilent_segment(audio_segment, min_silence_len=1000, silence_thresh=-16, seek_step=1):
+    samples, frame_rate, max_amplitude = audio_segment_samples(audio_segment)
+    return detect_nonsilent(samples, frame_rate, max_amplitude, min_silence_len, silence_thresh, seek_step)
+
+
+# RMS of a whole recording, as pydub reports it (integer audio is truncated like audioop.rms). Read a block
+# at a time, so samples may be a memory-mapped recording.
+def recording_rms(samples, block_frames=2 ** 20):
+    energy = 0
+    for block_start in range(0, len(samples), block_frames):
+        block = np.asarray(samples[block_start:block_start + block_frames])
+        if samples.dtype.kind in "iu" and samples.dtype.itemsize <= 2:
+            energy += int(np.square(block, dtype=np.int64).sum())
+        else:
+            energy += float(np.square(block, dtype=np.float64).sum())
+    rms = np.sqrt(energy / samples.size) if samples.size else 0.0
+    return float(np.floor(rms)) if samples.dtype.kind in "iu" else float(rms)
+
+
+# Level of a whole recording in dBFS, as pydub reports it for an AudioSegment
+def recording_level_db(samples, max_amplitude):
+    rms = recording_rms(samples)
+    return 20 * np.log10(rms / max_amplitude) if rms > 0 else -np.inf
+
+
+# Run detect_nonsilent for every combination of min_silence_lens and silence thresholds (linear RMS values on
+# the scale of samples, rather than dBFS) at once. Each block of windows is measured once per min_silence_len,
+# and every threshold is then applied to it. Returns chunks[i][j], the nonsilent chunks found with
+# min_silence_lens[i] and thresholds[j], each an (n, 2) array exactly as detect_nonsilent would return.
+def detect_nonsilent_grid(samples, frame_rate, min_silence_lens, thresholds, seek_step=1):
+    seg_len = duration_ms(len(samples), frame_rate)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    return [[nonsilent_ranges(ranges, seg_len)
+             for ranges in silent_ranges(samples, frame_rate, min_silence_len, thresholds, seek_step)]
+            for min_silence_len in min_silence_lens]
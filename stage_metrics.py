@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+import contextlib
+import cProfile
+import json
+import time
+import tracemalloc
+
+
+# Records how long each stage of processing takes, how much memory it needs at most, and counts of the items
+# it handles, so a slow trial shows where its time went. Peak memory is measured with tracemalloc (which
+# sees numpy's arrays as well as Python objects); track_memory=False skips that, as it slows down
+# allocation-heavy code.
+class StageMetrics:
+    def __init__(self, track_memory=True):
+        self.track_memory = track_memory
+        self.stages = []
+        self.counters = {}
+
+    # Time the code inside a with block as one stage
+    @contextlib.contextmanager
+    def stage(self, name):
+        started_tracing = False
+        if self.track_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = {"stage": name, "wall_s": time.perf_counter() - start}
+            if self.track_memory:
+                # Memory the stage needed beyond what was already allocated when it began
+                record["peak_memory_mb"] = (tracemalloc.get_traced_memory()[1] - start_memory) / 2 ** 20
+                if started_tracing:
+                    tracemalloc.stop()
+            self.stages.append(record)
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + int(amount)
+
+    def as_dict(self):
+        return {"total_s": sum(record["wall_s"] for record in self.stages), "stages": self.stages,
+                "counters": self.counters}
+
+    def write_json(self, filename):
+        with open(filename, 'w') as metrics_file:
+            json.dump(self.as_dict(), metrics_file, indent=2)
+
+    def summary(self):
+        return "Stages: " + ", ".join(f"{record['stage']} {record['wall_s']:.2f} s" for record in self.stages)
+
+
+# Profile the code inside a with block with cProfile, saving the stats to filename (nothing is profiled if
+# filename is None). Open the stats with pstats or a viewer such as snakeviz.
+@contextlib.contextmanager
+def profiled(filename):
+    if filename is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(filename)
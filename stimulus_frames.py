@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+import hashlib
+import os
+import numpy as np
+
+
+# Draw black text centred on a copy of a blank white frame
+def render_text_frame(width, height, text, font, font_scale, thickness):
+    import cv2
+    frame = np.full((height, width, 3), fill_value=255, dtype=np.uint8)
+
+    # Define parameters for positioning text on the frame from the size of the text
+    textsize = cv2.getTextSize(text, font, 1, 2)[0]
+    textX = int((width - textsize[0] * font_scale) / 2)
+    textY = int((height + textsize[1] * font_scale) / 2)
+    cv2.putText(frame, text, (textX, textY), font, font_scale, color=(0, 0, 0), thickness=thickness)
+    return frame
+
+
+# Renders full screen text frames on first use only. If cache_dir is given, rendered frames are also saved
+# there (keyed by resolution, text and font parameters) and loaded back memory-mapped on later runs.
+class FrameCache:
+    def __init__(self, width, height, font, cache_dir=None):
+        self.width = width
+        self.height = height
+        self.font = font
+        self.cache_dir = cache_dir
+        self.frames = {}
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _filename(self, text, font_scale, thickness):
+        key = repr((self.width, self.height, self.font, text, float(font_scale), int(thickness)))
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".npy")
+
+    def get(self, text, font_scale, thickness):
+        key = (text, font_scale, thickness)
+        if key not in self.frames:
+            filename = None if self.cache_dir is None else self._filename(text, font_scale, thickness)
+            if filename is not None and os.path.isfile(filename):
+                self.frames[key] = np.load(filename, mmap_mode='r')
+            else:
+                self.frames[key] = render_text_frame(self.width, self.height, text, self.font, font_scale, thickness)
+                if filename is not None:
+                    np.save(filename, self.frames[key])
+        return self.frames[key]
+
+    # Render the frames for only the letters a sequence actually uses. Returns the list of frames and, for
+    # each position in the sequence, the index of its frame in that list.
+    def sequence_frames(self, letter_sequence, font_scale, thickness):
+        letters, frame_indices = np.unique(np.asarray(letter_sequence, dtype=str), return_inverse=True)
+        frames = [self.get(str(letter), font_scale, thickness) for letter in letters]
+        return frames, frame_indices.ravel()
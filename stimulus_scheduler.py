@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+import time
+import numpy as np
+
+
+# Presents events at absolute deadlines on a monotonic clock, so the time spent drawing each frame never
+# accumulates as drift. Deadlines are given in seconds since start_time (on the same clock). Each event is
+# issued early by the running average of how long drawing takes, so the frame lands on its deadline.
+class StimulusScheduler:
+    def __init__(self, start_time=None, clock=time.perf_counter, sleep=time.sleep, spin_s=0.002):
+        self.clock = clock
+        self.sleep = sleep
+        # Time before a deadline at which we stop sleeping and busy-wait instead (sleep isn't precise)
+        self.spin_s = spin_s
+        self.start_time = clock() if start_time is None else start_time
+        self.render_s = 0.0
+        self.num_renders = 0
+        self.intended = []
+        self.actual = []
+
+    def now(self):
+        return self.clock() - self.start_time
+
+    # Wait until the given time (s since start_time)
+    def wait_until(self, deadline):
+        remaining = deadline - self.now()
+        if remaining > self.spin_s:
+            self.sleep(remaining - self.spin_s)
+        while self.now() < deadline:
+            pass
+
+    # Call render() so that it finishes at the deadline, and record when it actually did. Returns that time.
+    def present(self, deadline, render, record=True):
+        self.wait_until(deadline - self.render_s)
+        render_start = self.now()
+        render()
+        onset = self.now()
+        # Keep a running average of the drawing time to compensate for on the next frame
+        self.num_renders += 1
+        self.render_s += ((onset - render_start) - self.render_s) / self.num_renders
+        if record:
+            self.intended.append(deadline)
+            self.actual.append(onset)
+        return onset
+
+    # Onset errors (actual - intended, s) of every recorded event
+    def onset_errors(self):
+        return np.array(self.actual) - np.array(self.intended)
+
+    # Mean, standard deviation and maximum absolute onset error (s)
+    def jitter_stats(self):
+        errors = self.onset_errors()
+        if len(errors) == 0:
+            return float('nan'), float('nan'), float('nan')
+        return float(np.mean(errors)), float(np.std(errors)), float(np.max(np.abs(errors)))
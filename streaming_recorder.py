@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+import queue
+import threading
+import time
+import numpy as np
+import soundfile
+
+
+# Records from the microphone straight to a WAV file. The sounddevice callback only copies each block into
+# a small preallocated ring buffer; a writer thread drains the ring to disk (and hands each block to
+# on_block, if given), so memory use doesn't grow with the length of the session and a crash loses at most
+# the blocks still in the ring.
+#
+# The default FLOAT subtype stores the same float32 samples that sd.rec + wavfile.write used to. Recording
+# stops being saved after max_frames frames, if given, so the file is exactly as long as sd.rec's would be.
+#
+# The callback also keeps the time the device captured the first sample of the first and latest blocks (on
+# the stream's clock) and how that clock relates to clock, so recording_times can place events timed on
+# clock (e.g. stimulus onsets) on the recording itself, input latency and any sample clock drift included.
+class StreamingRecorder:
+    def __init__(self, filename, sample_rate, channels=1, block_size=1024, ring_blocks=64, subtype='FLOAT',
+                 max_frames=None, on_block=None, clock=time.perf_counter):
+        self.filename = filename
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.block_size = block_size
+        self.subtype = subtype
+        self.max_frames = max_frames
+        self.on_block = on_block
+        self.clock = clock
+        self.ring = np.zeros((ring_blocks, block_size, channels), dtype=np.float32)
+        # Slots (and their frame counts) waiting to be written; one slot is always left for the writer to
+        # work on, so the callback never overwrites a block before it is saved
+        self.pending = queue.Queue(maxsize=ring_blocks - 1)
+        self.next_slot = 0
+        self.done = threading.Event()
+        # Counters: blocks the device itself dropped, blocks dropped because the ring was full, and frames lost
+        self.input_overflows = 0
+        self.ring_overruns = 0
+        self.dropped_frames = 0
+        self.frames_recorded = 0
+        self.frames_written = 0
+        # (frame of the recording, capture time on the stream's clock) of the first and latest blocks, and
+        # clock minus the stream's clock (the smallest difference seen, i.e. the callback that ran soonest)
+        self.first_block = None
+        self.last_block = None
+        self.clock_offset = float('inf')
+        self.input_latency_s = float('nan')
+        self.file = None
+        self.stream = None
+        self.writer = threading.Thread(target=self._write, daemon=True)
+
+    def _callback(self, indata, frames, time_info, status):
+        # Some host APIs leave the timestamps at 0, in which case the stream's own clock and latency are used
+        now = self.clock()
+        stream_time = time_info.currentTime or self.stream.time
+        self.clock_offset = min(self.clock_offset, now - stream_time)
+        capture_time = time_info.inputBufferAdcTime or stream_time - self.input_latency_s - frames / self.sample_rate
+        if status.input_overflow:
+            self.input_overflows += 1
+        if self.pending.full():
+            self.ring_overruns += 1
+            self.dropped_frames += frames
+            return
+        slot = self.next_slot
+        self.ring[slot, :frames] = indata
+        self.next_slot = (slot + 1) % len(self.ring)
+        self.last_block = (self.frames_recorded, capture_time)
+        if self.first_block is None:
+            self.first_block = self.last_block
+        self.frames_recorded += frames
+        self.pending.put_nowait((slot, frames))
+
+    def _write(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            slot, frames = item
+            if self.max_frames is not None:
+                frames = min(frames, self.max_frames - self.frames_written)
+            if frames <= 0:
+                self.done.set()
+                continue
+            block = self.ring[slot, :frames]
+            self.file.write(block)
+            self.frames_written += frames
+            if self.on_block is not None:
+                self.on_block(block)
+            if self.max_frames is not None and self.frames_written >= self.max_frames:
+                self.done.set()
+
+    def start(self):
+        import sounddevice as sd
+        self.file = soundfile.SoundFile(self.filename, mode='w', samplerate=self.sample_rate, channels=self.channels,
+                                        subtype=self.subtype)
+        self.writer.start()
+        self.stream = sd.InputStream(samplerate=self.sample_rate, channels=self.channels, dtype='float32',
+                                     blocksize=self.block_size, callback=self._callback)
+        self.input_latency_s = self.stream.latency
+        self.stream.start()
+
+    # Block until max_frames frames have been saved (like sd.wait), then stop
+    def wait(self):
+        self.done.wait()
+        self.stop()
+
+    # Stop recording, save whatever is left in the ring and close the file
+    def stop(self):
+        if self.stream is None:
+            return
+        self.stream.stop()
+        self.stream.close()
+        self.stream = None
+        self.pending.put(None)
+        self.writer.join()
+        self.file.close()
+
+    # Where on the recording (s from its first sample) events that happened at the given times on clock are.
+    # Times on clock are moved onto the stream's clock, then onto the recording's frames along the line through
+    # the first and latest blocks' capture times, so the recording's actual sample rate is used. Frames
+    # dropped from a full ring shift everything after them and aren't accounted for.
+    def recording_times(self, clock_times):
+        if self.first_block is None:
+            raise RuntimeError("Nothing has been recorded yet")
+        first_frame, first_time = self.first_block
+        last_frame, last_time = self.last_block
+        seconds_per_frame = (last_time - first_time) / (last_frame - first_frame) if last_frame > first_frame \
+            else 1.0 / self.sample_rate
+        stream_times = np.asarray(clock_times, dtype=np.float64) - self.clock_offset
+        return (first_frame + (stream_times - first_time) / seconds_per_frame) / self.sample_rate
+
+    # Seconds on clock per second of recording (1 if the sound card's sample clock keeps perfect time)
+    def sample_clock_ratio(self):
+        return float(self.recording_times(1.0) - self.recording_times(0.0)) ** -1
+
+    def summary(self):
+        return (f"Recorded {self.frames_written / self.sample_rate:.1f} s to {self.filename} "
+                f"({self.input_overflows} input overflows, {self.ring_overruns} ring overruns, "
+                f"{self.dropped_frames} frames dropped)")
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+import csv
+import numpy as np
+import process_nback
+import response_matching
+import session_store
+import speech_detection
+
+""" ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~  TUNABLE PARAMETERS    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ """
+# Trial whose recording (<TRIAL_NAME>.wav) and stimuli are used to try out detection settings
+TRIAL_NAME = "nback_test"
+
+# Silence thresholds to try, in dB relative to the recording's overall level (process_nback.py's
+# SILENCE_THRESHOLD_OFFSET_DB; 0 is the threshold process_nback.py has always used)
+THRESHOLD_OFFSETS_DB = [-9.0, -7.5, -6.0, -4.5, -3.0, -1.5, 0.0, 1.5, 3.0, 4.5, 6.0]
+
+# Minimum periods of silence (ms) separating two responses to try (process_nback.py's MIN_PERIOD_SILENCE_MS)
+MIN_PERIODS_SILENCE_MS = [200, 300, 400, 500, 600, 800, 1000]
+
+# Number of best settings printed (every setting is written to <TRIAL_NAME>_sweep.csv)
+NUM_BEST_SHOWN = 5
+""" ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ """
+
+# Columns of the rows returned by sweep_trial
+SWEEP_HEADER = ['Threshold offset (dB)', 'Min silence (ms)', 'Responses detected', 'Stimuli matched',
+                'Stimuli matched (%)', 'Median reaction time (s)']
+
+
+# Try every combination of silence threshold and minimum silence on one recording, measuring each block of
+# its energy envelope only once per minimum silence. As in process_nback.py, windows at or below (offset dB
+# relative to) the RMS of the whole recording count as silent. Returns one row per setting, best first: most
+# stimuli matched to a response, then the number of responses closest to the number of stimuli that warrant one.
+def sweep_trial(trial_name, threshold_offsets_db=THRESHOLD_OFFSETS_DB, min_periods_silence_ms=MIN_PERIODS_SILENCE_MS,
+                n=process_nback.N, num_tests=process_nback.NUM_TESTS,
+                response_window_s=process_nback.STIMULUS_INTERVAL_S + process_nback.INTERIAL_INTERVAL_S):
+    stimuli_time_stamps = session_store.load_session(trial_name)["stimulus_times"][:num_tests]
+    samples, frame_rate, max_amplitude = speech_detection.wav_samples(trial_name + ".wav")
+    level = speech_detection.recording_rms(samples)
+    thresholds = level * speech_detection.db_to_ratio(np.asarray(threshold_offsets_db, dtype=np.float64))
+    chunks = speech_detection.detect_nonsilent_grid(samples, frame_rate, min_periods_silence_ms, thresholds)
+
+    rows = []
+    expected_responses = max(len(stimuli_time_stamps) - n, 0)
+    for i, min_silence_len in enumerate(min_periods_silence_ms):
+        for j, offset_db in enumerate(threshold_offsets_db):
+            # Responses starting at the very beginning of the recording are dropped, as in process_nback.py
+            markers = chunks[i][j][:, 0] / 1000.0
+            markers = markers[markers != 0.0]
+            clip_index, reaction_times = response_matching.match_responses(stimuli_time_stamps, markers, n,
+                                                                           response_window_s)
+            matched = clip_index >= 0
+            num_matched = int(np.count_nonzero(matched))
+            rows.append([offset_db, min_silence_len, len(markers), num_matched,
+                         100.0 * num_matched / expected_responses if expected_responses else float('nan'),
+                         float(np.median(reaction_times[matched])) if num_matched else float('nan')])
+    rows.sort(key=lambda row: (-row[3], abs(row[2] - expected_responses)))
+    return rows
+
+
+if __name__ == "__main__":
+    rows = sweep_trial(TRIAL_NAME)
+    with open(TRIAL_NAME + "_sweep.csv", 'w') as sweep_file:
+        writer = csv.writer(sweep_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(SWEEP_HEADER)
+        writer.writerows(rows)
+    print(f"Tried {len(rows)} settings on {TRIAL_NAME}.wav, best first:")
+    for row in rows[:NUM_BEST_SHOWN]:
+        print("  SILENCE_THRESHOLD_OFFSET_DB = %5.1f, MIN_PERIOD_SILENCE_MS = %4d: %d responses, %d stimuli matched "
+              "(%.0f%%), median reaction time %.3f s" % tuple(row))
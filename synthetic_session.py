@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+import numpy as np
+import soundfile
+from scipy.io import loadmat
+import session_store
+
+""" ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~  TUNABLE PARAMETERS    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ """
+# Name of the synthesized trial (<TRIAL_NAME>.wav, its session store and <TRIAL_NAME>.csv are written)
+TRIAL_NAME = "synthetic_test"
+
+# Matlab file holding the letter sequence (repeated if the session needs more letters than it has), and N
+MAT_FILE_NAME = "NBACK_2_VersionA.mat"
+N = 2
+
+# Length of the session (minutes), and the timing of the stimuli (as in run_nback.py)
+SESSION_MINUTES = 1.0
+STIMULUS_INTERVAL_S = 0.75
+INTERIAL_INTERVAL_S = 2.00
+
+# Level (dBFS) of the background noise and of the loudest part of each response, the chance that a stimulus
+# gets a response, and the range of reaction times and response lengths (s)
+NOISE_DB = -55.0
+SPEECH_DB = -12.0
+RESPONSE_RATE = 0.9
+REACTION_TIME_RANGE_S = (0.4, 1.2)
+RESPONSE_LENGTH_RANGE_S = (0.25, 0.6)
+
+SAMPLE_RATE = 44100
+SEED = 0
+""" ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ """
+
+# Length (s) of the blocks the recording is synthesized and written in, so long sessions never have to fit
+# in memory at once
+BLOCK_S = 60.0
+
+
+# A voice-like burst: a few harmonics of a gliding fundamental under a smooth attack/decay envelope
+def voice_burst(rng, num_frames, sample_rate, amplitude):
+    t = np.arange(num_frames) / sample_rate
+    fundamental = rng.uniform(100.0, 250.0) * (1.0 + rng.uniform(-0.15, 0.15) * t / max(t[-1], 1e-9))
+    phase = 2 * np.pi * np.cumsum(fundamental) / sample_rate
+    burst = sum(np.sin(k * phase) / k for k in range(1, 6))
+    attack = np.minimum(t / 0.02, 1.0)
+    decay = np.minimum((t[-1] - t) / 0.05, 1.0)
+    return amplitude * burst / np.max(np.abs(burst)) * attack * decay
+
+
+# Synthesize a session: stimuli shown every STIMULUS_INTERVAL_S + INTERIAL_INTERVAL_S seconds from 1 s in (as
+# run_nback.py shows them), and a recording of background noise with a voice-like response to each stimulus
+# (after the first n) that gets one. Writes <trial_name>.wav and the session store (with the true onset of
+# every response, in s, as synthetic_onsets), and exports <trial_name>.csv. Returns the true onsets.
+def synthesize_session(trial_name, minutes=SESSION_MINUTES, mat_file_name=MAT_FILE_NAME, n=N,
+                       stimulus_interval_s=STIMULUS_INTERVAL_S, interial_interval_s=INTERIAL_INTERVAL_S,
+                       noise_db=NOISE_DB, speech_db=SPEECH_DB, response_rate=RESPONSE_RATE,
+                       reaction_time_range_s=REACTION_TIME_RANGE_S, response_length_range_s=RESPONSE_LENGTH_RANGE_S,
+                       sample_rate=SAMPLE_RATE, seed=SEED):
+    rng = np.random.default_rng(seed)
+    period_s = stimulus_interval_s + interial_interval_s
+    num_tests = max(int((minutes * 60.0 - 1.0) // period_s), n + 1)
+    mat = loadmat(mat_file_name)
+    letter_sequence = np.resize(mat["Sequence"], num_tests)
+    answer_array = np.where(np.concatenate((np.zeros(n, dtype=bool), letter_sequence[n:] == letter_sequence[:-n]))
+                            if n > 0 else np.zeros(num_tests, dtype=bool), "Y", "N")
+    stimuli_time_stamps = 1.0 + np.arange(num_tests) * period_s
+
+    # Which stimuli are answered, when, and for how long
+    responds = (np.arange(num_tests) >= n) & (rng.random(num_tests) < response_rate)
+    onsets = stimuli_time_stamps[responds] + rng.uniform(*reaction_time_range_s, np.count_nonzero(responds))
+    lengths = rng.uniform(*response_length_range_s, len(onsets))
+    onset_frames = np.round(onsets * sample_rate).astype(np.int64)
+    length_frames = np.round(lengths * sample_rate).astype(np.int64)
+
+    # The recording lasts as long as run_nback.py's would
+    total_frames = int((num_tests * period_s + 10) * sample_rate)
+    noise_amplitude = 32768 * 10 ** (noise_db / 20.0)
+    speech_amplitude = 32768 * 10 ** (speech_db / 20.0)
+    block_frames = int(BLOCK_S * sample_rate)
+    with soundfile.SoundFile(trial_name + ".wav", mode='w', samplerate=sample_rate, channels=1,
+                             subtype='PCM_16') as wav_file:
+        for block_start in range(0, total_frames, block_frames):
+            block_end = min(block_start + block_frames, total_frames)
+            block = rng.normal(0.0, noise_amplitude, block_end - block_start)
+            # Add the part of every response that overlaps this block
+            for j in np.flatnonzero((onset_frames < block_end) & (onset_frames + length_frames > block_start)):
+                burst = voice_burst(np.random.default_rng([seed, j]), length_frames[j], sample_rate,
+                                    speech_amplitude)
+                lo = max(onset_frames[j], block_start)
+                hi = min(onset_frames[j] + length_frames[j], block_end)
+                block[lo - block_start:hi - block_start] += burst[lo - onset_frames[j]:hi - onset_frames[j]]
+            wav_file.write(np.clip(np.round(block), -32768, 32767).astype(np.int16))
+
+    session = session_store.save_session(trial_name, replace=True, n=n, letters=letter_sequence,
+                                         answers=answer_array, stimulus_times=stimuli_time_stamps,
+                                         intended_times=stimuli_time_stamps, onset_errors_ms=np.zeros(num_tests),
+                                         synthetic_onsets=onsets)
+    session_store.export_trial_csv(trial_name, session)
+    return onsets
+
+
+if __name__ == "__main__":
+    onsets = synthesize_session(TRIAL_NAME)
+    print(f"Synthesized {TRIAL_NAME}.wav ({SESSION_MINUTES:g} min, {len(onsets)} responses)")
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+import hashlib
+import sqlite3
+import time
+import numpy as np
+
+
+# Persistent cache of recognizer responses keyed by the clip's audio and the recognizer that heard it, so
+# clips whose audio hasn't changed are never sent to a recognizer twice. Holds at most max_entries
+# responses, evicting the least recently used ones first.
+class TranscriptionCache:
+    def __init__(self, filename, max_entries=100000):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # Several processes may share the cache file, so wait for each other's writes instead of failing
+        self.connection = sqlite3.connect(filename, timeout=60.0)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS transcripts "
+                                "(key TEXT PRIMARY KEY, response TEXT, last_used REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS transcripts_last_used ON transcripts (last_used)")
+        self.connection.commit()
+
+    # Content address of a clip: a hash of its samples and sample rate plus the recognizer's identity
+    @staticmethod
+    def key(recognizer, pcm16, frame_rate):
+        digest = hashlib.sha256(np.int64(frame_rate).tobytes())
+        digest.update(np.ascontiguousarray(pcm16, dtype=np.int16).tobytes())
+        return f"{recognizer.cache_id()}:{digest.hexdigest()}"
+
+    # Look up a clip. Returns (found, response); response may be None if the recognizer couldn't determine one
+    def get(self, key):
+        row = self.connection.execute("SELECT response FROM transcripts WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        self.connection.execute("UPDATE transcripts SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.connection.commit()
+        return True, row[0]
+
+    def put(self, key, response):
+        self.connection.execute("INSERT OR REPLACE INTO transcripts (key, response, last_used) VALUES (?, ?, ?)",
+                                (key, response, time.time()))
+        # Evict the least recently used responses once the cache is over its size limit
+        self.connection.execute("DELETE FROM transcripts WHERE key IN (SELECT key FROM transcripts "
+                                "ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+        self.connection.commit()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM transcripts").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+    def summary(self):
+        return f"Transcription cache: {self.hits} hits, {self.misses} misses ({len(self)} entries)"